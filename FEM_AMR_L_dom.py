@@ -7,17 +7,21 @@ with adaptive mesh refinement using a posteriori error estimator
 @author: bhttchr6
 
 """
+import json
+import time
+
 import numpy as np
 import scipy as S
 import scipy.linalg as la
 import scipy.sparse as sparse
 import scipy.sparse.linalg as sla
 
-from mpl_toolkits.mplot3d import Axes3D
-import matplotlib.pyplot as plt
 import meshpy.triangle as triangle
 
-plt.close('all')
+from FEM_mesh import AdaptiveMesh, MeshLocator, mesh_edges, vertex_ordering
+from FEM_profile import count, gauge, phase, profiled
+from FEM_solvers import LinearSolver
+
 
 def f(xvec):
     x, y = xvec
@@ -27,20 +31,91 @@ def f(xvec):
         return 0.0
 
 class MatrixBuilder:
-    def __init__(self):
-        self.rows = []
-        self.cols = []
-        self.vals = []
+    """
+    Array-backed triplet builder. The row/col/val arrays are preallocated
+    for ne element blocks of size nb x nb and filled in place. Once the
+    triplets of a mesh are known, setup_pattern computes the CSR sparsity
+    and the triplet-to-nonzero scatter map, so that reassembling the
+    matrix on the same mesh is a single bincount into the CSR data.
+    """
+    def __init__(self, ne=0, nb=6):
+        self.rows = np.empty(ne*nb*nb, dtype=np.int32)
+        self.cols = np.empty(ne*nb*nb, dtype=np.int32)
+        self.vals = np.empty(ne*nb*nb, dtype=np.float64)
+        self.n = 0
+        self.shape = None
+        self.indptr = None
+        self.indices = None
+        self.scatter = None
+    
+    def _reserve(self, m):
+        # grow geometrically when more triplets arrive than preallocated
+        if self.n + m <= len(self.vals):
+            return
+        size = max(self.n + m, 2*len(self.vals))
+        for name in ('rows', 'cols', 'vals'):
+            old = getattr(self, name)
+            new = np.empty(size, dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
         
     def add(self, rows, cols, submat):
-        for i, ri in enumerate(rows):
-            for j, cj in enumerate(cols):
-                self.rows.append(ri)
-                self.cols.append(cj)
-                self.vals.append(submat[i, j])
+        self.add_batch(np.asarray(rows)[None, :], np.asarray(cols)[None, :],
+                       np.asarray(submat)[None, :, :])
+    
+    def add_batch(self, rows, cols, submats):
+        """
+        Add a stack of element blocks. rows (nblk, r), cols (nblk, c) and
+        submats (nblk, r, c).
+        """
+        nblk, r, c = submats.shape
+        m = nblk*r*c
+        self._reserve(m)
+        sl = slice(self.n, self.n+m)
+        self.rows[sl] = np.repeat(rows, c, axis=1).ravel()
+        self.cols[sl] = np.tile(cols, (1, r)).ravel()
+        self.vals[sl] = submats.ravel()
+        self.n += m
+        # any cached pattern is stale now
+        self.scatter = None
                 
-    def coo_matrix(self):
-        return sparse.coo_matrix((self.vals, (self.rows, self.cols)))
+    def coo_matrix(self, shape=None):
+        n = self.n
+        return sparse.coo_matrix((self.vals[:n], (self.rows[:n], self.cols[:n])),
+                                 shape=shape)
+    
+    def setup_pattern(self, shape=None):
+        """
+        Compute the CSR sparsity pattern of the current triplets and the
+        map from every triplet to its slot in the CSR data array.
+        """
+        n = self.n
+        if shape is None:
+            shape = (int(self.rows[:n].max())+1, int(self.cols[:n].max())+1)
+        key = self.rows[:n].astype(np.int64)*shape[1] + self.cols[:n]
+        uniq, scatter = np.unique(key, return_inverse=True)
+        idx_type = np.int32 if len(uniq) < np.iinfo(np.int32).max else np.int64
+        self.shape = shape
+        self.indices = (uniq % shape[1]).astype(idx_type)
+        counts = np.bincount(uniq // shape[1], minlength=shape[0])
+        self.indptr = np.zeros(shape[0]+1, dtype=idx_type)
+        np.cumsum(counts, out=self.indptr[1:])
+        self.scatter = scatter.astype(idx_type).ravel()
+    
+    def csr_matrix(self, vals=None, shape=None):
+        """
+        Sum the triplet values into CSR format. vals (optional) replaces
+        the stored values, in the same order as the triplets were added,
+        which is how a matrix is reassembled on an unchanged mesh.
+        """
+        if self.scatter is None:
+            self.setup_pattern(shape)
+        if vals is None:
+            vals = self.vals[:self.n]
+        data = np.bincount(self.scatter, weights=np.ravel(vals),
+                           minlength=len(self.indices))
+        return sparse.csr_matrix((data, self.indices, self.indptr),
+                                 shape=self.shape)
  
 def coo_submatrix_pull(matr, rows, cols):
     """
@@ -68,11 +143,107 @@ def coo_submatrix_pull(matr, rows, cols):
     return S.sparse.coo_matrix((matr.data[newelem], np.array([gr[newrows],
         gc[newcols]])),(lr, lc))    
     
+class DirichletBC:
+    """
+    Homogeneous Dirichlet constraints of one mesh. The free/fixed DOF
+    split is computed once; the map from the nonzeros of a CSR matrix to
+    the free-free block is computed on first use and reused for every
+    matrix with the same sparsity pattern.
+    
+    Three ways of imposing the constraints are available:
+        'reduce'    - extract the free-free block (smaller system)
+        'eliminate' - zero fixed rows/cols in place, unit diagonal
+        'penalty'   - add a large spring to the fixed diagonal in place
+    """
+    def __init__(self, fixed_mask):
+        self.mask = np.asarray(fixed_mask, dtype=bool)
+        self.ndof = len(self.mask)
+        self.fixed = np.flatnonzero(self.mask)
+        self.free = np.flatnonzero(~self.mask)
+        self._pattern = None
+        
+    @classmethod
+    def from_vertices(cls, is_boundary):
+        """Clamp both DOFs of every vertex flagged in is_boundary."""
+        return cls(np.repeat(np.asarray(is_boundary, dtype=bool), 2))
+    
+    def _setup_pattern(self, K):
+        if self._pattern is not None:
+            indptr, indices = self._pattern[:2]
+            if (K.indices is indices or
+                    (len(K.indices) == len(indices) and
+                     np.array_equal(K.indptr, indptr) and
+                     np.array_equal(K.indices, indices))):
+                return self._pattern
+        n = K.shape[0]
+        row = np.repeat(np.arange(n), np.diff(K.indptr))
+        keep = ~(self.mask[row] | self.mask[K.indices])
+        
+        # free-free block in the renumbered free DOFs
+        gmap = np.full(n, -1, dtype=K.indices.dtype)
+        gmap[self.free] = np.arange(len(self.free))
+        red_indices = gmap[K.indices[keep]]
+        red_indptr = np.zeros(len(self.free)+1, dtype=K.indptr.dtype)
+        np.cumsum(np.bincount(gmap[row[keep]], minlength=len(self.free)),
+                  out=red_indptr[1:])
+        
+        # positions of the fixed diagonal entries, for the in-place modes
+        diag = np.flatnonzero(self.mask[row] & (row == K.indices))
+        if len(diag) != len(self.fixed):
+            raise ValueError('Fixed DOFs need a stored diagonal entry')
+        self._pattern = (K.indptr, K.indices, keep, red_indices,
+                         red_indptr, diag)
+        return self._pattern
+        
+    def reduce(self, K):
+        """Free-free block of the CSR matrix K."""
+        with phase('bc_reduction'):
+            _, _, keep, red_indices, red_indptr, _ = self._setup_pattern(K)
+            nf = len(self.free)
+            return sparse.csr_matrix((K.data[keep], red_indices, red_indptr),
+                                     shape=(nf, nf))
+    
+    def apply(self, K, F, mode='eliminate', penalty=1e8):
+        """
+        Impose the constraints on the full CSR matrix K and load vector F
+        in place. In 'penalty' mode the spring stiffness is penalty times
+        the largest diagonal entry.
+        """
+        _, _, keep, _, _, diag = self._setup_pattern(K)
+        if mode == 'eliminate':
+            K.data[~keep] = 0.0
+            K.data[diag] = 1.0
+        elif mode == 'penalty':
+            K.data[diag] += penalty*np.abs(K.diagonal()).max()
+        else:
+            raise ValueError('Unknown constraint mode: %s' % mode)
+        F[self.fixed] = 0.0
+        return K, F
+    
+    def expand(self, u_f, out=None):
+        """Scatter a free-DOF vector back to the full DOF vector."""
+        if out is None:
+            out = np.zeros(self.ndof)
+        out[self.free] = u_f
+        return out
+
+# Outline of the L-domain and its clamped part, the top edge of the L
+L_POINTS = ((0, 0), (1, 0), (1, 0.5), (0.5, 0.5), (0.5, 1), (0, 1))
+CLAMPED_EDGE = ((0, 1), (0.5, 1))
+
 def round_trip_connect(start, end):
     return [(i, i+1) for i in range(start, end)] + [(end, start)]
 
-def make_mesh(flag, marked_elem,itr):
-    points = [(0, 0), (1, 0), (1, 0.5), (0.5, 0.5), (0.5,1), (0,1)]
+@profiled('meshing')
+def make_mesh(flag, marked_elem,itr, size=0.01, points=None):
+    """
+    Triangulate the L-domain, or the polygon points when given. size
+    scales the maximum element area (size*(1+|centroid|_inf)); halving
+    it roughly doubles the DOFs.
+    """
+    if points is None:
+        points = L_POINTS
+    points = [tuple(p) for p in points]
     #points = [(0, 0), (1, 0), (1,1), (0,1)]
     facets = round_trip_connect(0, len(points)-1)
 
@@ -85,7 +256,7 @@ def make_mesh(flag, marked_elem,itr):
 
     def needs_refinement(vertices, area):
         bary = np.sum(np.array(vertices), axis=0)/3
-        control_element_size_param = 0.01
+        control_element_size_param = size
         max_area = control_element_size_param + la.norm(bary, np.inf)*control_element_size_param
         #max_area = 1 + la.norm(bary, np.inf)*1
         return bool(area > max_area)
@@ -97,67 +268,237 @@ def make_mesh(flag, marked_elem,itr):
     built_mesh = triangle.build(info, refinement_func=needs_refinement)
     if flag==1:
         built_mesh.element_volumes.setup()
-        for i in range(len(built_mesh.elements)):
-            built_mesh.element_volumes[i] = -1
-        for i in range(0, len(built_mesh.elements)):
-            if i in marked_elem:
-             built_mesh.element_volumes[i] = 0.001
+        vols = np.full(len(built_mesh.elements), -1.0)
+        vols[np.asarray(marked_elem, dtype=int)] = 0.001
+        for i, vol in enumerate(vols):
+            built_mesh.element_volumes[i] = vol
     
         built_mesh = triangle.refine(built_mesh)
         
     return np.array(built_mesh.points), np.array(built_mesh.elements)
 
-def max_edge_len(x0,x1,x2):
-    
-    eps = 0.0001
-    
-    
-    
-    v_1_x = x1[0]-x0[0]+eps
-    v_1_y = x1[1]-x0[1]+eps
-    e_1 = (v_1_x**2+v_1_y**2)**(1/2)
-    b1 = (1/(1+(v_1_y**2/v_1_x**2)))**(1/2)
-    a1 = -b1*(v_1_y/v_1_x)
-    
-    v_1 = np.array([a1,b1])
-    
-    # edge 2
-    v_2_x = x2[0]-x1[0]+eps
-    v_2_y = x2[1]-x1[1]+eps
-    e_2 = (v_2_x**2+v_2_y**2)**(1/2)
-    b2 = (1/(1+(v_2_y**2/v_2_x**2)))**(1/2)
-    a2 = -b2*(v_2_y/v_2_x)
-    v_2 = np.array([a2,b2])
-    
-    # edge 1
-    v_3_x = x2[0]-x0[0]+eps
-    v_3_y = x2[1]-x0[1]+eps
-    e_3 = (v_3_x**2+v_3_y**2)**(1/2)
-    b3 = (1/(1+(v_3_y**2/v_3_x**2)))**(1/2)
-    a3 = -b3*(v_3_y/v_3_x)
-    v_3 = np.array([a3,b3])
-        
-    h = np.amax([e_1, e_2, e_3])
+@profiled('meshing')
+def quadratic_mesh(V, E):
+    """
+    Six-node (P2) triangles on the mesh (V, E). The edge midpoints are
+    appended to the vertices, so vertex indices are kept, and element
+    k is [v0, v1, v2, m01, m12, m20].
+    Returns the nodes (nv+ned, 2) and elements (ne, 6).
+    """
+    edges, el2edge, _ = mesh_edges(E)
+    V2 = np.concatenate((V, 0.5*(V[edges[:, 0]] + V[edges[:, 1]])))
+    E2 = np.concatenate((E, len(V)+el2edge), axis=1)
+    return V2, E2
 
-    return h,v_1,v_2,v_3
-# Form Stiffness matrix and Internal stress vectors
-def FEM_Ktan_Fint(V,E, x_load, y_load, U,load_dir):
-    ne = len(E)
-    nv = len(V)
+def element_dofs(E):
+    """
+    Global DOF map of every element, shape (ne, 2*nodes), ordered
+    [x0, y0, x1, y1, x2, y2, ...] like the element vectors.
+    """
+    dofs = np.empty((len(E), 2*E.shape[1]), dtype=np.int64)
+    dofs[:, 0::2] = 2*E
+    dofs[:, 1::2] = 2*E+1
+    return dofs
+
+def element_jacobians(V, E):
+    """
+    Jacobian determinants (ne,) and inverse Jacobians (ne, 2, 2) of the
+    linear triangles, with J = [x1-x0, x2-x0] stored row-wise.
+    """
+    x0 = V[E[:, 0]]
+    J = np.stack((V[E[:, 1]]-x0, V[E[:, 2]]-x0), axis=1)
+    detJ = J[:, 0, 0]*J[:, 1, 1] - J[:, 0, 1]*J[:, 1, 0]
+    
+    # inv(J) written out for the 2x2 case
+    invJ = np.empty_like(J)
+    invJ[:, 0, 0] = J[:, 1, 1]
+    invJ[:, 0, 1] = -J[:, 0, 1]
+    invJ[:, 1, 0] = -J[:, 1, 0]
+    invJ[:, 1, 1] = J[:, 0, 0]
+    invJ /= detJ[:, None, None]
+    return detJ, invJ
+
+def B_matrices(invJ):
+    """Strain-displacement matrices (ne, 3, 6) from inverse Jacobians."""
     dbasis = np.array([
         [-1, 1, 0],
         [-1, 0, 1]])
     
-    
-    
-    dN_ds = np.array([
-        [-1, 0, 1, 0, 0, 0],
-        [0, -1, 0, 0, 0, 1]])
-    
-    YM = 10
-    mu = 0.3
-    
-    cond=1
+    # dbasis = J @ dN_dx
+    return strain_displacement(invJ @ dbasis)
+
+def strain_displacement(dN_dx):
+    """
+    Strain-displacement matrices (..., 3, 2n) from the shape function
+    gradients dN_dx (..., 2, n).
+    """
+    n = dN_dx.shape[-1]
+    B = np.zeros(dN_dx.shape[:-2] + (3, 2*n))
+    B[..., 0, 0::2] = dN_dx[..., 0, :]
+    B[..., 1, 1::2] = dN_dx[..., 1, :]
+    B[..., 2, 0::2] = dN_dx[..., 1, :]
+    B[..., 2, 1::2] = dN_dx[..., 0, :]
+    return B
+
+def element_B(V, E):
+    """
+    Batched strain-displacement matrices of the linear triangles.
+    Returns B with shape (ne, 3, 6) and detJ with shape (ne,).
+    """
+    detJ, invJ = element_jacobians(V, E)
+    return B_matrices(invJ), detJ
+
+# Gauss rules on the reference triangle by polynomial degree: points
+# (xi, eta) and weights, which sum to the reference area 1/2. Degree 2
+# is exact for every six-node integrand here (B^T C B, the consistent
+# gravity load and the element means of linear stresses).
+TRIANGLE_QUADRATURE = {
+    2: (np.array([[1/6, 1/6], [2/3, 1/6], [1/6, 2/3]]), np.full(3, 1/6)),
+    }
+
+def p2_shape(xi):
+    """
+    Quadratic shape functions N (nq, 6) and their reference gradients
+    dN (nq, 2, 6) at the points xi (nq, 2), nodes ordered as in
+    quadratic_mesh.
+    """
+    s, t = np.atleast_2d(xi).T
+    r = 1-s-t
+    N = np.stack((r*(2*r-1), s*(2*s-1), t*(2*t-1), 4*r*s, 4*s*t, 4*t*r),
+                 axis=1)
+    z = np.zeros_like(s)
+    dN = np.stack((np.stack((1-4*r, 4*s-1, z, 4*(r-s), 4*t, -4*t), axis=1),
+                   np.stack((1-4*r, z, 4*t-1, -4*s, 4*s, 4*(r-t)), axis=1)),
+                  axis=1)
+    return N, dN
+
+def element_B_p2(V, E, xi):
+    """
+    Strain-displacement matrices of the quadratic triangles (ne, 6
+    nodes) at the reference points xi (nq, 2).
+    Returns B with shape (ne, nq, 3, 12) and detJ with shape (ne,).
+    """
+    detJ, invJ = element_jacobians(V, E)
+    _, dN = p2_shape(xi)
+    return strain_displacement(np.einsum('eij,qjk->eqik', invJ, dN)), detJ
+
+class MeshGeometry:
+    """
+    Geometry of one mesh (V, E), shared by assembly, post-processing and
+    error estimation. Every field is computed on first access and kept
+    as a contiguous array:
+        dofs (ne, 6), detJ/area (ne,), invJ (ne, 2, 2), B (ne, 3, 6),
+        centroids (ne, 2), edges/el2edge/edge2el (see mesh_edges),
+        edge_len (ned,), normals (ned, 2), h (ne,) longest edge,
+        locator (FEM_mesh.MeshLocator)
+    On six-node elements (see quadratic_mesh) B is (ne, nq, 3, 12) at the
+    points of TRIANGLE_QUADRATURE[2] and the edge fields refer to the
+    element corners.
+    Call invalidate() whenever the mesh changes, e.g. after
+    AdaptiveMesh.refine, to drop the stale fields.
+    """
+    def __init__(self, V, E):
+        self.V = V
+        self.E = E
+        self._fields = {}
+        
+    def invalidate(self, V=None, E=None):
+        if V is not None:
+            self.V = V
+        if E is not None:
+            self.E = E
+        self._fields.clear()
+        
+    def _lazy(self, name, compute):
+        if name not in self._fields:
+            with phase('geometry'):
+                self._fields.update(compute())
+        return self._fields[name]
+    
+    def _jacobians(self):
+        detJ, invJ = element_jacobians(self.V, self.E)
+        return {'detJ': detJ, 'area': detJ/2.0, 'invJ': invJ}
+    
+    def _edges(self):
+        edges, el2edge, edge2el = mesh_edges(self.E[:, :3])
+        t = self.V[edges[:, 1]] - self.V[edges[:, 0]]
+        edge_len = np.hypot(t[:, 0], t[:, 1])
+        normals = np.stack((t[:, 1], -t[:, 0]), axis=1)/edge_len[:, None]
+        return {'edges': edges, 'el2edge': el2edge, 'edge2el': edge2el,
+                'edge_len': edge_len, 'normals': normals,
+                'h': edge_len[el2edge].max(axis=1)}
+    
+    @property
+    def ne(self):
+        return len(self.E)
+    
+    @property
+    def order(self):
+        return 2 if self.E.shape[1] == 6 else 1
+    
+    @property
+    def nv(self):
+        return len(self.V)
+    
+    @property
+    def dofs(self):
+        return self._lazy('dofs', lambda: {'dofs': element_dofs(self.E)})
+    
+    @property
+    def detJ(self):
+        return self._lazy('detJ', self._jacobians)
+    
+    @property
+    def area(self):
+        return self._lazy('area', self._jacobians)
+    
+    @property
+    def invJ(self):
+        return self._lazy('invJ', self._jacobians)
+    
+    @property
+    def B(self):
+        if self.order == 2:
+            xi = TRIANGLE_QUADRATURE[2][0]
+            return self._lazy('B', lambda: {'B': element_B_p2(self.V, self.E,
+                                                               xi)[0]})
+        return self._lazy('B', lambda: {'B': B_matrices(self.invJ)})
+    
+    @property
+    def centroids(self):
+        return self._lazy('centroids',
+                          lambda: {'centroids': self.V[self.E].mean(axis=1)})
+    
+    @property
+    def edges(self):
+        return self._lazy('edges', self._edges)
+    
+    @property
+    def el2edge(self):
+        return self._lazy('el2edge', self._edges)
+    
+    @property
+    def edge2el(self):
+        return self._lazy('edge2el', self._edges)
+    
+    @property
+    def edge_len(self):
+        return self._lazy('edge_len', self._edges)
+    
+    @property
+    def normals(self):
+        return self._lazy('normals', self._edges)
+    
+    @property
+    def h(self):
+        return self._lazy('h', self._edges)
+    
+    @property
+    def locator(self):
+        return self._lazy('locator',
+                          lambda: {'locator': MeshLocator(self.V, self.E)})
+
+def elasticity_matrix(YM=10, mu=0.3, cond=1):
     if cond==1:  # plane stress
         sc = YM/(1-mu**2)
         C = np.array([
@@ -172,326 +513,524 @@ def FEM_Ktan_Fint(V,E, x_load, y_load, U,load_dir):
             [(1-mu)*sc, mu*sc, 0],
             [mu*sc, (1-mu)*sc, 0],
             [0, 0, ((1-2*mu)/2)*sc]])
-    
-    
-    a_builder = MatrixBuilder()
-    Fint = np.zeros(2*nv)
-    ext_dof = []
-    
-    for ei in range(0, ne):
-        vert_indices = E[ei, :]
-        
-        
-        x0, x1, x2 = el_verts = V[vert_indices]
-        
-        x_dofs = vert_indices*2
-        y_dofs = vert_indices*2+1
-        #print(x_dofs)
-        
-        if (x0[0]==x_load) & (x0[1]==y_load):
-            ext_dof = vert_indices[0]*2+load_dir
-        if (x1[0]==x_load) & (x1[1]==y_load):
-            ext_dof = vert_indices[1]*2+load_dir    
-        if (x2[0]==x_load) & (x2[1]==y_load):
-            ext_dof = vert_indices[2]*2+load_dir    
-        el_indices = np.array([
-            x_dofs[0],
-            y_dofs[0],
-            x_dofs[1],
-            y_dofs[1],
-            x_dofs[2],
-            y_dofs[2]])
-        #print(el_indices)
-        el_disp = np.array([
-            U[x_dofs[0]],
-            U[y_dofs[0]],
-            U[x_dofs[1]],
-            U[y_dofs[1]],
-            U[x_dofs[2]],
-            U[y_dofs[2]]
-            ])
-        centroid = np.mean(el_verts, axis=0)
-    
-        J = np.array([x1-x0, x2-x0])
+    return C
+
+class Problem:
+    """
+    Definition of one case: Young's modulus YM, Poisson ratio mu,
+    density rho and gravity g, plane stress (cond=1) or plane strain
+    (cond=0), the domain outline points and mesh size, the clamped
+    boundary segment and the point load (x, y, dir, value). Parameters
+    not given keep the values of the original L-domain problem.
+    """
+    defaults = {'YM': 10, 'mu': 0.3, 'rho': 0.1, 'g': 10, 'cond': 1,
+                'points': L_POINTS, 'size': 0.01, 'clamped': CLAMPED_EDGE,
+                'load': (1, 0.5, 1, -0.09)}
+    
+    def __init__(self, **params):
+        unknown = set(params) - set(self.defaults)
+        if unknown:
+            raise ValueError('Unknown problem parameters: %s'
+                             % ', '.join(sorted(unknown)))
+        for name, value in self.defaults.items():
+            setattr(self, name, params.get(name, value))
+    
+    def __repr__(self):
+        changed = ['%s=%r' % (k, v) for k, v in self.params().items()
+                   if v != self.defaults[k]]
+        return 'Problem(%s)' % ', '.join(changed)
+    
+    def params(self):
+        return {name: getattr(self, name) for name in self.defaults}
+    
+    def replace(self, **params):
+        """Copy with some parameters changed."""
+        return Problem(**dict(self.params(), **params))
+    
+    def C(self):
+        return elasticity_matrix(self.YM, self.mu, self.cond)
+    
+    def mesh_key(self):
+        """Problems with equal keys share their mesh."""
+        return (tuple(tuple(p) for p in self.points), self.size)
+    
+    def make_mesh(self):
+        return make_mesh(0, [], 0, self.size, self.points)
+
+DEFAULT_PROBLEM = Problem()
+
+def element_stiffness(V, E, C, geom=None):
+    """
+    Element stiffness matrices B^T C B |T|, shape (ne, 6, 6). Six-node
+    elements are passed on to element_stiffness_p2.
+    """
+    if E.shape[1] == 6:
+        return element_stiffness_p2(V, E, C, geom)
+    if geom is None:
+        B, detJ = element_B(V, E)
+    else:
+        B, detJ = geom.B, geom.detJ
+    return (detJ / 2.0)[:, None, None]*np.einsum('eki,kl,elj->eij', B, C, B)
+
+def element_body_force(V, E, rho=0.1, g=10, geom=None):
+    """
+    Gravity load of every element, shape (ne, 6), or (ne, 12) on
+    six-node elements.
+    """
+    if geom is None:
+        detJ, _ = element_jacobians(V, E)
+    else:
+        detJ = geom.detJ
+    if E.shape[1] == 6:
+        # consistent load, int N_i = 0 at the corners and |T|/3 at the
+        # midpoints
+        xi, w = TRIANGLE_QUADRATURE[2]
+        belem = np.zeros((len(E), 12))
+        belem[:, 1::2] = np.outer(detJ*rho*g, w @ p2_shape(xi)[0])
+        return belem
+    belem = np.zeros((len(E), 6))
+    belem[:, 1::2] = (detJ / 6.0)[:, None]*rho*g
+    return belem
+
+def element_stiffness_p2(V, E, C, geom=None):
+    """
+    Stiffness matrices of the quadratic triangles, shape (ne, 12, 12).
+    The strains are linear, so the degree 2 Gauss rule is exact.
+    """
+    xi, w = TRIANGLE_QUADRATURE[2]
+    if geom is None:
+        B, detJ = element_B_p2(V, E, xi)
+    else:
+        B, detJ = geom.B, geom.detJ
+    return detJ[:, None, None]*np.einsum('q,eqki,kl,eqlj->eij', w, B, C, B)
+
+class AssemblyCache:
+    """
+    Element stiffness blocks Ke (ne, nd, nd) and body-force vectors
+    fb (ne, nd) of the last mesh seen, plus its MatrixBuilder (nd is 6
+    on linear and 12 on quadratic triangles).
+    
+    update() recomputes only the elements that changed since the previous
+    mesh: either the changed set reported by AdaptiveMesh.refine (element
+    IDs are stable there) or, when no changed set is given, every element
+    whose vertex coordinates are not found in the cached mesh.
+    """
+    def __init__(self, C=None, problem=None):
+        self.problem = problem or DEFAULT_PROBLEM
+        self.C = self.problem.C() if C is None else C
+        self.Ke = None
+        self.fb = None
+        self.keys = None
+        self.builder = None
         
-        invJT = la.inv(J).T
-        detJ = la.det(J.T)
-        dN_dx = invJT @ dbasis
-        #print(dN_dx)
-        B = np.array([[dN_dx[0,0], 0 , dN_dx[0,1], 0, dN_dx[0,2], 0],
-                     [0, dN_dx[1,0], 0, dN_dx[1,1], 0, dN_dx[1,2]],
-                      [dN_dx[1,0],dN_dx[0,0],dN_dx[1,1],dN_dx[0,1],dN_dx[1,2],dN_dx[0,2]]])
+    @staticmethod
+    def _coord_keys(V, E):
+        xy = np.ascontiguousarray(V[E].reshape(len(E), -1))
+        return xy.view(np.dtype((np.void,
+                                 xy.dtype.itemsize*xy.shape[1]))).ravel()
         
-        #print(B)
-        eps= B@el_disp
-        sigma = C@eps
-        fint = (detJ / 2.0)*B.T@sigma
-        Aelem = (detJ / 2.0) * B.T @C@ B
-    
-        #print(detJ)
-        gl_idx = np.array([
-            x_dofs[1],
-            y_dofs[1],
-            x_dofs[2],
-            y_dofs[2],
-            x_dofs[0],
-            y_dofs[0]])
-        #print(gl_idx)
-        a_builder.add(el_indices, el_indices, Aelem)
-        for i, vi in enumerate(el_indices):
-            Fint[vi] += fint[i]
+    def update(self, V, E, changed=None, pool=None):
+        """
+        Bring the cache up to date with (V, E). Returns the indices of
+        the recomputed elements. pool (optional) is a
+        FEM_parallel.ElementPool for the element kernels.
+        """
+        ne = len(E)
+        nd = 2*E.shape[1]
+        p = self.problem
+        keys = self._coord_keys(V, E)
+        if self.Ke is None or self.Ke.shape[1] != nd:
+            changed = np.arange(ne)
+            Ke = np.empty((ne, nd, nd))
+            fb = np.empty((ne, nd))
+        elif changed is not None:
+            changed = np.asarray(changed, dtype=np.int64)
+            Ke = np.resize(self.Ke, (ne, nd, nd))
+            fb = np.resize(self.fb, (ne, nd))
+        else:
+            # match elements on their vertex coordinates
+            n_old = len(self.keys)
+            _, inv = np.unique(np.concatenate((self.keys, keys)),
+                               return_inverse=True)
+            inv = inv.ravel()
+            lookup = np.full(inv.max()+1, -1)
+            lookup[inv[:n_old]] = np.arange(n_old)
+            src = lookup[inv[n_old:]]
+            changed = np.flatnonzero(src < 0)
+            kept = src >= 0
+            Ke = np.empty((ne, nd, nd))
+            fb = np.empty((ne, nd))
+            Ke[kept] = self.Ke[src[kept]]
+            fb[kept] = self.fb[src[kept]]
         
-    Ktan = a_builder.coo_matrix().tocsr().tocoo()
-    return ext_dof,Ktan, Fint
+        with phase('element_kernels'):
+            if len(changed) and pool is not None:
+                Ke[changed] = pool.stiffness(V, E[changed], self.C)
+                fb[changed] = pool.body_force(V, E[changed], p.rho, p.g)
+            elif len(changed):
+                Ke[changed] = element_stiffness(V, E[changed], self.C)
+                fb[changed] = element_body_force(V, E[changed], p.rho, p.g)
+        count('recomputed_elements', len(changed))
+        if (self.keys is None or len(changed) or ne != len(self.keys)):
+            self.builder = None
+        self.Ke, self.fb, self.keys = Ke, fb, keys
+        return changed
 
-def int_stress(E,V,U):
-    ne = len(E)
+@profiled('assembly')
+def assemble_stiffness(V, E, C=None, a_builder=None, cache=None, geom=None,
+                       pool=None):
+    """
+    Global stiffness matrix (CSR) and the element blocks (ne, nd, nd)
+    it was summed from. The optional arguments are as in FEM_Ktan_Fint.
+    """
+    if geom is None:
+        geom = MeshGeometry(V, E)
+    if C is None:
+        C = elasticity_matrix()
     nv = len(V)
-    dbasis = np.array([
-        [-1, 1, 0],
-        [-1, 0, 1]])
-    
-    
-    
-    dN_ds = np.array([
-        [-1, 0, 1, 0, 0, 0],
-        [0, -1, 0, 0, 0, 1]])
-    
-    YM = 10
-    mu = 0.3
-    
-    cond=1
-    if cond==1:  # plane stress
-        sc = YM/(1-mu**2)
-        C = np.array([
-            [sc, mu*sc, 0],
-            [mu*sc, sc, 0],
-            [0, 0, (1-mu)*sc]])
+    el_indices = geom.dofs
     
+    # Element stiffnesses, reused from the cache when given
+    if cache is not None:
+        Aelem = cache.Ke
+        if a_builder is None:
+            a_builder = cache.builder
+    else:
+        with phase('element_kernels'):
+            if pool is not None:
+                Aelem = pool.stiffness(V, E, C)
+            else:
+                Aelem = element_stiffness(V, E, C, geom)
+    
+    # The sparsity pattern is set up once per mesh, after that the
+    # element matrices are scattered straight into the CSR data
+    if a_builder is None:
+        a_builder = MatrixBuilder(len(E), el_indices.shape[1])
+    if a_builder.scatter is None:
+        with phase('coo_build'):
+            a_builder.add_batch(el_indices, el_indices, Aelem)
+            a_builder.setup_pattern((2*nv, 2*nv))
+    with phase('csr_scatter'):
+        Ktan = a_builder.csr_matrix(Aelem)
+    gauge('nnz', Ktan.nnz)
+    if cache is not None:
+        cache.builder = a_builder
+    return Ktan, Aelem
+
+class StiffnessOperator(sla.LinearOperator):
+    """
+    Matrix-free stiffness matrix for the Krylov solvers: K x is applied
+    as a gather of the element DOFs, the element products and a
+    scatter-add, without assembling K.
+
+    Ke (optional) are stored element matrices (ne, nd, nd), e.g. the
+    AssemblyCache's. Without them the products are formed on the fly
+    from the geometry as B^T C B u_e, which only keeps B in memory.
+    With bc (a DirichletBC) the operator acts on the free DOFs only,
+    like bc.reduce(K).
+    """
+    def __init__(self, V, E, C=None, Ke=None, geom=None, bc=None):
+        self.geom = MeshGeometry(V, E) if geom is None else geom
+        self.C = elasticity_matrix() if C is None else C
+        self.Ke = Ke
+        self.bc = bc
+        self.ndof = 2*len(V)
+        n = self.ndof if bc is None else len(bc.free)
+        super().__init__(np.float64, (n, n))
+
+    def _element_products(self, ue):
+        if self.Ke is not None:
+            return np.einsum('eij,ej->ei', self.Ke, ue)
+        g = self.geom
+        if g.order == 2:
+            w = TRIANGLE_QUADRATURE[2][1]
+            sig = np.einsum('eqki,ei->eqk', g.B, ue) @ self.C.T
+            sig *= (g.detJ[:, None]*w)[:, :, None]
+            return np.einsum('eqki,eqk->ei', g.B, sig)
+        sig = np.einsum('eki,ei->ek', g.B, ue) @ self.C.T
+        sig *= g.area[:, None]
+        return np.einsum('eki,ek->ei', g.B, sig)
+
+    def _matvec(self, x):
+        x = np.ravel(x)
+        if self.bc is not None:
+            x = self.bc.expand(x)
+        dofs = self.geom.dofs
+        ye = self._element_products(x[dofs])
+        y = np.bincount(dofs.ravel(), weights=ye.ravel(),
+                        minlength=self.ndof)
+        count('matvecs')
+        return y if self.bc is None else y[self.bc.free]
+
+    def _rmatvec(self, x):
+        return self._matvec(x)
+
+    def diagonal(self):
+        """Diagonal of K (for the Jacobi preconditioner)."""
+        g = self.geom
+        if self.Ke is not None:
+            de = np.einsum('eii->ei', self.Ke)
+        elif g.order == 2:
+            w = TRIANGLE_QUADRATURE[2][1]
+            de = np.einsum('q,e,eqki,kl,eqli->ei', w, g.detJ, g.B, self.C,
+                           g.B)
+        else:
+            de = g.area[:, None]*np.einsum('eki,kl,eli->ei', g.B, self.C,
+                                           g.B)
+        d = np.bincount(g.dofs.ravel(), weights=de.ravel(),
+                        minlength=self.ndof)
+        return d if self.bc is None else d[self.bc.free]
+
+# Form Stiffness matrix and Internal stress vectors
+def FEM_Ktan_Fint(V,E, x_load, y_load, U,load_dir, a_builder=None, cache=None,
+                  geom=None, pool=None, problem=None):
+    """
+    a_builder (optional) is a MatrixBuilder already set up for this mesh;
+    passing it back in skips the sparsity pattern computation.
+    cache (optional) is an AssemblyCache already updated for this mesh.
+    geom (optional) is the MeshGeometry of this mesh.
+    pool (optional) is a FEM_parallel.ElementPool for the element kernels.
+    problem (optional) is the Problem holding the material constants.
+    """
+    if geom is None:
+        geom = MeshGeometry(V, E)
+    if problem is None:
+        problem = DEFAULT_PROBLEM
+    nv = len(V)
     
-    if cond == 0: # plane strain
-        sc = YM/((1-2*mu)*(1+mu))
-        C = np.array([
-            [(1-mu)*sc, mu*sc, 0],
-            [mu*sc, (1-mu)*sc, 0],
-            [0, 0, ((1-2*mu)/2)*sc]])
+    C = problem.C()
     
+    # DOFs carrying the load (one vertex, or the element containing it)
+    ext_dof, _ = geom.locator.point_load(x_load, y_load, load_dir)
     
-    a_builder = MatrixBuilder()
-    Fint = np.zeros(2*nv)
-    ext_dof = []
+    Ktan, Aelem = assemble_stiffness(V, E, C, a_builder, cache, geom, pool)
     
-    for ei in range(0, ne):
-        vert_indices = E[ei, :]
-        
-        
-        x0, x1, x2 = el_verts = V[vert_indices]
-        
-        x_dofs = vert_indices*2
-        y_dofs = vert_indices*2+1
-        #print(x_dofs)
-        
-            
-        el_indices = np.array([
-            x_dofs[0],
-            y_dofs[0],
-            x_dofs[1],
-            y_dofs[1],
-            x_dofs[2],
-            y_dofs[2]])
-        #print(el_indices)
-        el_disp = np.array([
-            U[x_dofs[0]],
-            U[y_dofs[0]],
-            U[x_dofs[1]],
-            U[y_dofs[1]],
-            U[x_dofs[2]],
-            U[y_dofs[2]]
-            ])
-        centroid = np.mean(el_verts, axis=0)
-    
-        J = np.array([x1-x0, x2-x0])
-        
-        invJT = la.inv(J).T
-        detJ = la.det(J.T)
-        dN_dx = invJT @ dbasis
-        #print(dN_dx)
-        B = np.array([[dN_dx[0,0], 0 , dN_dx[0,1], 0, dN_dx[0,2], 0],
-                     [0, dN_dx[1,0], 0, dN_dx[1,1], 0, dN_dx[1,2]],
-                      [dN_dx[1,0],dN_dx[0,0],dN_dx[1,1],dN_dx[0,1],dN_dx[1,2],dN_dx[0,2]]])
-        
-        #print(B)
-        eps= B@el_disp
-        sigma = C@eps
-        fint = (detJ / 2.0)*B.T@sigma
-        Aelem = (detJ / 2.0) * B.T @C@ B
-    
-        #print(detJ)
-        gl_idx = np.array([
-            x_dofs[1],
-            y_dofs[1],
-            x_dofs[2],
-            y_dofs[2],
-            x_dofs[0],
-            y_dofs[0]])
-        #print(gl_idx)
-        
-        for i, vi in enumerate(el_indices):
-            Fint[vi] += fint[i]
-        norm_fint = la.norm(Fint, np.inf)    
-    return Fint, norm_fint
+    # Internal forces Ke @ u_e of all elements in one shot
+    el_indices = geom.dofs
+    fint = np.einsum('eij,ej->ei', Aelem, U[el_indices])
+    Fint = np.bincount(el_indices.ravel(), weights=fint.ravel(), minlength=2*nv)
+    return ext_dof,Ktan, Fint
 
+@profiled()
+def post_process(V, E, U, YM=10, mu=0.3, cond=1, rho=0.1, g=10, geom=None,
+                 problem=None):
+    """
+    Fused post-processing of a displacement field in one vectorized pass
+    over the element geometry. Returns a dict with the element strains
+    and stresses (ne, 3), von Mises stress (ne,), nodal internal force
+    and body force vectors (2*nv,) and their L_inf norms. On six-node
+    elements the strains and stresses are the element means, i.e. the
+    values at the centroid. A problem (optional) overrides the material
+    arguments.
+    """
+    if geom is None:
+        geom = MeshGeometry(V, E)
+    if problem is not None:
+        YM, mu, cond = problem.YM, problem.mu, problem.cond
+        rho, g = problem.rho, problem.g
+    nv = len(V)
+    C = elasticity_matrix(YM, mu, cond)
+    el_indices = geom.dofs
+    B, detJ = geom.B, geom.detJ
+    
+    if geom.order == 2:
+        w = TRIANGLE_QUADRATURE[2][1]
+        eps_q = np.einsum('eqij,ej->eqi', B, U[el_indices])
+        sig_q = eps_q @ C.T
+        fint = detJ[:, None]*np.einsum('q,eqki,eqk->ei', w, B, sig_q)
+        eps, sigma = eps_q.mean(axis=1), sig_q.mean(axis=1)
+        belem = element_body_force(V, E, rho, g, geom)
+    else:
+        eps = np.einsum('eij,ej->ei', B, U[el_indices])
+        sigma = eps @ C.T
+        fint = (detJ / 2.0)[:, None]*np.einsum('eki,ek->ei', B, sigma)
+        belem = np.zeros((len(E), 6))
+        belem[:, 1::2] = (detJ / 6.0)[:, None]*rho*g
+    
+    sxx, syy, sxy = sigma.T
+    szz = mu*(sxx+syy) if cond == 0 else 0.0
+    von_mises = np.sqrt(0.5*((sxx-syy)**2 + (syy-szz)**2 + (szz-sxx)**2)
+                        + 3*sxy**2)
+    
+    dofs = el_indices.ravel()
+    Fint = np.bincount(dofs, weights=fint.ravel(), minlength=2*nv)
+    Fb = np.bincount(dofs, weights=belem.ravel(), minlength=2*nv)
+    return {'strain': eps, 'stress': sigma, 'von_mises': von_mises,
+            'Fint': Fint, 'Fb': Fb,
+            'norm_fint': la.norm(Fint, np.inf), 'norm_fb': la.norm(Fb, np.inf),
+            'max_von_mises': von_mises.max()}
 
-def body_force (E, V):
-    ne = len(E)
+def int_stress(E,V,U, geom=None, problem=None):
+    post = post_process(V, E, U, geom=geom, problem=problem)
+    return post['Fint'], post['norm_fint']
+
+
+@profiled()
+def body_force (E, V, cache=None, geom=None, pool=None, problem=None):
+    if geom is None:
+        geom = MeshGeometry(V, E)
+    if problem is None:
+        problem = DEFAULT_PROBLEM
     nv = len(V)
-    Fb = np.zeros(2*nv)
-    rho = 0.1
-    g = 10
-    for ei in range(0, ne):
-        vert_indices = E[ei, :]
-        x0, x1, x2 = el_verts = V[vert_indices]
-        centroid = np.mean(el_verts, axis=0)
-        x_dofs = vert_indices*2
-        y_dofs = vert_indices*2+1
-        
-        J = np.array([x1-x0, x2-x0]).T
-        detJ = la.det(J)
-    
-        el_indices = np.array([
-            x_dofs[0],
-            y_dofs[0],
-            x_dofs[1],
-            y_dofs[1],
-            x_dofs[2],
-            y_dofs[2]])
-    
-        belem = (detJ / 6.0) * np.array([
-            0,
-            rho*g,
-            0,
-            rho*g,
-            0,
-            rho*g
-            ])
-    
-        for i, vi in enumerate(el_indices):
-            Fb[vi] += belem[i] 
+    rho = problem.rho
+    g = problem.g
+    if cache is not None:
+        belem = cache.fb
+    elif pool is not None:
+        belem = pool.body_force(V, E, rho, g)
+    else:
+        belem = element_body_force(V, E, rho, g, geom)
+    Fb = np.bincount(geom.dofs.ravel(), weights=belem.ravel(),
+                     minlength=2*nv)
     return Fb  
 
-def error_estimator(V,E, u):
-    X, Y = V[:, 0], V[:, 1]
-    nv = len(V)
+@profiled('estimator')
+def error_estimator(V,E, u, geom=None, pool=None, problem=None, theta=0.5,
+                    load=None):
+    """
+    Residual a posteriori error estimator, vectorized over the mesh.
+    eta_K = h^2/(24K) ||R_K||^2 + h/(24K) sum_e w_e |e| |[[sigma n]]_e|^2
+    with the element residual R_K = f + div(sigma) (div(sigma) vanishes
+    on linear elements, leaving the gravity load) and the traction jumps
+    over the element edges: w_e = 1/2 on interior edges (shared with the
+    neighbour), 1 on traction free boundary edges and 0 on the clamped
+    boundary. On six-node elements the stresses are linear, div(sigma)
+    is kept in R_K, the jumps are integrated along the edges and h is
+    replaced by h/2. geom (optional) is the MeshGeometry of this mesh,
+    pool (optional) a FEM_parallel.ElementPool for the element stresses,
+    problem (optional) the Problem with the material and clamped edge.
+    load (optional) is an additional volume load int f.v + s:eps(v) as
+    (f, s) per element, f (ne, 2) and s (ne, 3) in Voigt order (either
+    can be None): f enters R_K and sigma - s the jumps, e.g. the goal
+    density of an adjoint problem (see goal_estimator).
+    mark holds the elements a Doerfler marking with theta selects, or
+    None with theta=None when the caller marks on its own.
+    """
+    if geom is None:
+        geom = MeshGeometry(V, E)
+    if problem is None:
+        problem = DEFAULT_PROBLEM
     ne = len(E)
-    dbasis = np.array([
-    [-1, 1, 0],
-    [-1, 0, 1]])
-    rho = 0.1
-    g = 10
-    YM = 10
-    mu = 0.3
+    rho = problem.rho
+    g = problem.g
+    YM = problem.YM
+    mu = problem.mu
     K = YM/(1-mu)
-    cond=1
-    if cond==1:  # plane stress
-        sc = YM/(1-mu**2)
-        C = np.array([
-            [sc, mu*sc, 0],
-            [mu*sc, sc, 0],
-            [0, 0, (1-mu)*sc]])
-    
-    
-    if cond == 0: # plane strain
-        sc = YM/((1-2*mu)*(1+mu))
-        C = np.array([
-            [(1-mu)*sc, mu*sc, 0],
-            [mu*sc, (1-mu)*sc, 0],
-            [0, 0, ((1-2*mu)/2)*sc]])
-   
-    
-    tol =1e-12
-    
-    is_boundary = ((np.abs(Y-1) < tol))
-    
-    eta_K = np.zeros(ne)
+    C = problem.C()
+    
+    is_boundary = geom.locator.boundary_vertices_on(*problem.clamped)
+    
+    edges, el2edge, edge2el = geom.edges, geom.el2edge, geom.edge2el
+    
+    # Element stresses at the corners (ne, 3, 3)
+    el_disp = u[geom.dofs]
+    if geom.order == 2:
+        corners = np.array([[0, 0], [1, 0], [0, 1]])
+        Bc, _ = element_B_p2(V, E, corners)
+        sig_c = np.einsum('eqij,ej->eqi', Bc, el_disp) @ C.T
+        # div(sigma) is constant, from the gradient of the linear stresses
+        dsig = np.einsum('eij,ejk->eik', geom.invJ,
+                         sig_c[:, 1:]-sig_c[:, :1])
+        div = np.stack((dsig[:, 0, 0] + dsig[:, 1, 2],
+                        dsig[:, 0, 2] + dsig[:, 1, 1]), axis=1)
+    else:
+        if pool is not None:
+            sigma = pool.stresses(V, E, u, C)
+        else:
+            eps = np.einsum('eij,ej->ei', geom.B, el_disp)
+            sigma = eps @ C.T
+        sig_c = np.repeat(sigma[:, None], 3, axis=1)
+        div = np.zeros((ne, 2))
+    f_load, s_load = (None, None) if load is None else load
+    if s_load is not None:
+        # constant per element, so it only changes the jumps
+        sig_c = sig_c - s_load[:, None]
+    
+    # Residuals ||f + div(sigma)||_K^2 with gravity f = (0, -rho g)
+    res = div
+    res[:, 1] -= rho*g
+    if f_load is not None:
+        res += f_load
+    R2 = np.sum(res**2, axis=1)*geom.area
+    
+    # Unit normals, oriented from edges[:,0] to edges[:,1]
+    n = geom.normals
+    h = geom.h/geom.order
+    
+    # Traction jumps [[sigma n]] at both ends of every edge; they vary
+    # linearly along the edge, so |e| (a^2 + ab + b^2)/3 integrates them
+    def traction(el, v):
+        s = sig_c[el, np.argmax(E[el, :3] == v[:, None], axis=1)]
+        return np.stack((s[:, 0]*n[:, 0] + s[:, 2]*n[:, 1],
+                         s[:, 2]*n[:, 0] + s[:, 1]*n[:, 1]), axis=1)
+    interior = edge2el[:, 1] >= 0
+    other = np.where(interior, edge2el[:, 1], edge2el[:, 0])
+    ja, jb = [traction(edge2el[:, 0], edges[:, k]) -
+              interior[:, None]*traction(other, edges[:, k])
+              for k in range(2)]
+    jump2 = np.sum(ja**2 + ja*jb + jb**2, axis=1)/3
+    w = np.where(interior, 0.5, 1.0)
+    w[~interior & is_boundary[edges].all(axis=1)] = 0.0
+    J = (w*geom.edge_len*jump2)[el2edge].sum(axis=1)
+    
+    c1 = h**2/(24*K)
+    c2 = h/(24*K)
+    eta_K = c1*R2 + c2*J
+    eta = eta_K.sum()
+    
+    # Relative error, skipping elements with all vertices clamped
+    norm_u = la.norm(el_disp, axis=1)
     e_rel = np.zeros(ne)
-    eta = 0
-    
-    mark =[]
-    ele_size = 0
-    for ei in range(0, ne):
-            vert_indices = E[ei, :]
-            x0, x1, x2 = el_verts = V[vert_indices]
-            x_dofs = vert_indices*2
-            y_dofs = vert_indices*2+1
-            val0,val1,val2 = is_boundary[vert_indices]
-            
-            
-            #u_el = u[vert_indices]
-            el_disp = np.array([
-            u[x_dofs[0]],
-            u[y_dofs[0]],
-            u[x_dofs[1]],
-            u[y_dofs[1]],
-            u[x_dofs[2]],
-            u[y_dofs[2]],
-            ])
-            
-            h,v_1,v_2,v_3 =  max_edge_len(x0,x1,x2)
-            
-            
-            
-            
-            ele_size = ele_size+h
-            #error_el = u_ex_el-u_el
-            J1 = la.norm(v_1@dbasis,2) 
-            J2 = la.norm(v_2@dbasis,2)
-            J3 = la.norm(v_3@dbasis,2)
-            
-            
-            Jacob = np.array([x1-x0, x2-x0]).T
-            invJT = la.inv(Jacob.T)
-            detJ = la.det(Jacob)
-            dN_dx = invJT @ dbasis
-            #print(dN_dx)
-            B = np.array([[dN_dx[0,0], 0 , dN_dx[0,1], 0, dN_dx[0,2], 0],
-                         [0, dN_dx[1,0], 0, dN_dx[1,1], 0, dN_dx[1,2]],
-                          [dN_dx[1,0],dN_dx[0,0],dN_dx[1,1],dN_dx[0,1],dN_dx[1,2],dN_dx[0,2]]])
-            eps = B@el_disp.T
-            sigma = C@eps
-            centroid = np.mean(el_verts, axis=0)
-            belem = (detJ / 6.0) * np.array([
-            0,
-            rho*g,
-            0,
-            rho*g,
-            0,
-            rho*g
-            ])
-            
-            R_val = belem+B.T@sigma
-            R = la.norm(R_val,2)
-            
-            if ((val0 ==True) & (val1 ==True)):
-                J1 ==0
-            if ((val1 ==True) & (val2 ==True)):
-                J2 ==0
-            if ((val2 ==True) & (val0 ==True)):
-                J3 ==0    
-            J =J1**2+J2**2+J3**2
-            c1 = h**2/(24*K)
-            c2 = h/(24*K)
-            eta_K[ei] = (c1*R**2+ c2*(J))
-            eta = eta +eta_K[ei]
-            if ((val0==False) | (val1==False)|(val2==False)):
-                
-                e_rel[ei] = eta_K[ei]/la.norm(el_disp,2)
-            if (e_rel[ei]>0.1):
-                mark.append(ei)
-    ele_size=ele_size/ne
+    np.divide(eta_K, norm_u, out=e_rel,
+              where=~is_boundary[E].all(axis=1) & (norm_u > 0))
+    mark = None
+    if theta is not None:
+        mark = mark_elements(eta_K, 'doerfler', theta)
+    ele_size = h.mean()
     return mark, eta_K,eta, e_rel, ele_size
 
 
-def FEM_sol(V,E):
+@profiled('solve')
+def FEM_sol(V,E, bc=None, bc_mode='reduce', solver=None, U0=None,
+            cache=None, changed=None, geom=None, pool=None, problem=None,
+            matrix_free=None, prolongations=None, ordering=None):
+    """
+    bc (optional) is the DirichletBC of this mesh, reused between solves.
+    bc_mode selects how it is imposed, see DirichletBC.
+    solver (optional) is a FEM_solvers.LinearSolver, the default is the
+    direct SuperLU solve. Its stats hold iterations and timings afterwards.
+    U0 (optional) is an initial guess for iterative solvers, e.g. the
+    previous AMR cycle's solution prolongated onto this mesh.
+    cache (optional) is an AssemblyCache carried over the AMR cycles, so
+    only the elements in changed (as returned by AdaptiveMesh.refine, or
+    found by coordinate matching when None) are recomputed.
+    geom (optional) is the MeshGeometry of this mesh.
+    pool (optional) is a FEM_parallel.ElementPool running the element
+    kernels on several cores.
+    problem (optional) is the Problem to solve (material, clamped edge
+    and point load), the original L-domain case by default. A cache
+    holds the element matrices and body forces of one material and
+    density, a ValueError is raised when they are not the problem's.
+    matrix_free (optional) skips the global assembly and solves with a
+    StiffnessOperator: 'cached' applies the stored element matrices
+    (the cache's when given), 'geometry' forms them on the fly. It
+    needs the 'cg' solver (the default then) with the jacobi or no
+    preconditioner, and bc_mode 'reduce'.
+    prolongations (optional) are the DOF prolongations of the mesh
+    hierarchy (see multigrid_prolongations) for the 'multigrid' solver
+    or the 'gmg' preconditioner; the fixed DOFs are taken out of them.
+    ordering (optional, 'rcm' or 'nd', see FEM_mesh.vertex_ordering)
+    permutes the reduced system into that vertex order for the solve
+    (see LinearSolver.setup), without renumbering the mesh. Only
+    solvers that keep the DOF order gain from it, so the default
+    solver is then the direct one with permc_spec='NATURAL'.
+    """
+    if problem is None:
+        problem = DEFAULT_PROBLEM
+    if ordering is not None and (matrix_free is not None or
+                                 bc_mode != 'reduce'):
+        raise ValueError('ordering needs an assembled matrix and bc_mode '
+                         'reduce')
     
     nv = len(V)
     ne = len(E)
@@ -503,17 +1042,12 @@ def FEM_sol(V,E):
     X, Y = V[:, 0], V[:, 1]    
     
     
-    # Specify load location
-    x_load = 1
-    y_load = 0.5
-    load_dir = 1
+    # Specify load location and external load value
+    x_load, y_load, load_dir, Fext_val = problem.load
     
     #x_load = 1
     #y_load = 1
     
-    # Specify external load value
-    Fext_val = -0.09
-    
     
     val=0
     '''
@@ -567,70 +1101,661 @@ def FEM_sol(V,E):
     #print(ext_dofs)
     '''
     U = np.zeros(2*nv)
+    gauge('dofs', 2*nv)
+    if geom is None:
+        geom = MeshGeometry(V, E)
+    
+    if cache is not None:
+        p = cache.problem
+        if (not np.array_equal(cache.C, problem.C()) or
+                (p.rho, p.g) != (problem.rho, problem.g)):
+            raise ValueError('The AssemblyCache was created for another '
+                             'material or density than the problem')
+        cache.update(V, E, changed, pool)
     
     # Get Ktan and Fint
-    ext_dof, Ktan, Fint = FEM_Ktan_Fint(V,E, x_load, y_load, U, load_dir)
+    if matrix_free is None:
+        ext_dof, Ktan, Fint = FEM_Ktan_Fint(V,E, x_load, y_load, U, load_dir,
+                                            cache=cache, geom=geom, pool=pool,
+                                            problem=problem)
+    elif matrix_free not in ('cached', 'geometry'):
+        raise ValueError('Unknown matrix-free mode: %s' % matrix_free)
+    elif bc_mode != 'reduce':
+        raise ValueError('The matrix-free solve needs bc_mode reduce')
     
     
     
     #print(ext_dof)
     
-    # Form Fext vector
+    # Form Fext vector, a load between vertices is shared by the
+    # vertices of its element
     Fext = np.zeros(2*nv)
-    Fext[ext_dof] = Fext_val
+    ext_dof, ext_val = geom.locator.point_load(x_load, y_load, load_dir,
+                                               Fext_val)
+    Fext[ext_dof] = ext_val
     
     
     
     # Body force
-    Fb = body_force (E, V)   
-    
-    tol = 1e-12
-    #is_boundary = ((np.abs(X) < tol))
+    Fb = body_force (E, V, cache, geom, pool, problem)   
     
+    if bc is None:
+        #is_boundary = ((np.abs(X) < tol))
+        
+        # BC for re-entrant corner
+        is_boundary = geom.locator.boundary_vertices_on(*problem.clamped)
+        bc = DirichletBC.from_vertices(is_boundary)
     
-    # BC for re-entrant corner
-    is_boundary = ((np.abs(Y-1) < tol))
-    
-    bc_num = np.count_nonzero(is_boundary==True)
-    
-    bc_dofs_x = np.zeros((bc_num,),dtype=int)
-    bc_dofs_y = np.zeros((bc_num,),dtype=int)
-    ctr=0
-    for i, vi in enumerate(is_boundary):
-        if(is_boundary[i]==True):
-            
-            bc_dofs_x[ctr]= i*2
-            bc_dofs_y[ctr]= i*2+1
-            ctr=ctr+1
-    
-    
-    all_dofs = np.arange(0,nv*2)
-    bc_dofs_p = np.sort(np.concatenate((bc_dofs_x,bc_dofs_y)))
-    bc_dofs_f = np.setdiff1d(all_dofs, bc_dofs_p)
-    #print(bc_dofs_f)
-    
-    Fint_f = np.take(Fint, bc_dofs_f)
-    Fext_f = np.take(Fext, bc_dofs_f)
-    Fb_f = np.take(Fb, bc_dofs_f)
-    #Ktan_1 = Ktan.tocsr()
-    #Ktan_f = Ktan_1[bc_dofs_f,bc_dofs_f]
-    Ktan_f = coo_submatrix_pull(Ktan, bc_dofs_f, bc_dofs_f)
-    #print(Ktan_f)
-    
-    F_eq = Fext_f-Fb_f
+    F_eq = Fext-Fb
     
+    if solver is None:
+        if matrix_free is not None:
+            solver = LinearSolver('cg')
+        elif ordering is not None:
+            solver = LinearSolver('direct', permc_spec='NATURAL')
+        else:
+            solver = LinearSolver('direct')
     
     # Obtain displacement vector
-    uhat = sla.spsolve(Ktan_f.tocsr(), F_eq)
-    
-    
-    U[bc_dofs_f]=uhat
+    if matrix_free is not None:
+        Ke = None
+        if matrix_free == 'cached':
+            Ke = (cache.Ke if cache is not None else
+                  element_stiffness(V, E, problem.C(), geom))
+        K_op = StiffnessOperator(V, E, problem.C(), Ke, geom, bc)
+        x0 = None if U0 is None else U0[bc.free]
+        uhat = solver.setup(K_op).solve(F_eq[bc.free], x0=x0)
+        bc.expand(uhat, out=U)
+    elif bc_mode == 'reduce':
+        Ktan_f = bc.reduce(Ktan)
+        F_f = F_eq[bc.free]
+        x0 = None if U0 is None else U0[bc.free]
+        kwargs = {}
+        if prolongations is not None:
+            # coarse vertices keep their numbers, so the fixed DOFs of a
+            # coarse level are the leading part of the fine mask
+            free = ~bc.mask
+            kwargs['prolongations'] = [P[free[:P.shape[0]]]
+                                       [:, free[:P.shape[1]]]
+                                       for P in prolongations]
+        if ordering is not None:
+            # free DOFs in the order of their vertices in vertex_ordering;
+            # the solver keeps the permutation, so later solves with it
+            # (e.g. the adjoint ones of goal_estimator) take the
+            # reduced DOF order as well
+            pos = np.full(2*nv, -1)
+            pos[bc.free] = np.arange(len(bc.free))
+            vperm = vertex_ordering(V, E, ordering)
+            perm = pos[(2*vperm[:, None] + np.arange(2)).ravel()]
+            kwargs['perm'] = perm[perm >= 0]
+        uhat = solver.setup(Ktan_f, **kwargs).solve(F_f, x0=x0)
+        bc.expand(uhat, out=U)
+    else:
+        bc.apply(Ktan, F_eq, mode=bc_mode)
+        kwargs = {}
+        if prolongations is not None:
+            kwargs['prolongations'] = prolongations
+        U = solver.setup(Ktan, **kwargs).solve(F_eq, x0=U0)
+        U[bc.fixed] = 0.0
 
     return U 
 
 
+
+def load_vector(V, E, case, Fb=None, geom=None, problem=None):
+    """
+    Right hand side of one load case, a dict with any of
+        'point':    [(x, y, dir, value), ...] point loads, shared by the
+                    element vertices when not on a vertex
+        'traction': [((x0, y0), (x1, y1), tx, ty), ...] uniform tractions
+                    on the boundary edges lying on the segment p0-p1
+        'gravity':  scaling of the body force (default 1)
+    Fb (optional) is the unscaled body force vector of the mesh.
+    """
+    if geom is None:
+        geom = MeshGeometry(V, E)
+    F = np.zeros(2*len(V))
+    
+    for x, y, load_dir, val in case.get('point', ()):
+        dofs, vals = geom.locator.point_load(x, y, load_dir, val)
+        np.add.at(F, dofs, vals)
+    
+    # consistent nodal shares of a uniform edge load, linear or quadratic
+    shares = {2: (1/2, 1/2), 3: (1/6, 1/6, 2/3)}
+    for p0, p1, tx, ty in case.get('traction', ()):
+        seg = geom.locator.boundary_edges_on(p0, p1)
+        length = np.hypot(*(V[seg[:, 1]]-V[seg[:, 0]]).T)
+        for k, s in enumerate(shares[seg.shape[1]]):
+            np.add.at(F, 2*seg[:, k], tx*s*length)
+            np.add.at(F, 2*seg[:, k]+1, ty*s*length)
+    
+    scale = case.get('gravity', 1.0)
+    if scale:
+        if Fb is None:
+            Fb = body_force(E, V, geom=geom, problem=problem)
+        F -= scale*Fb
+    return F
+
+@profiled()
+def solve_load_cases(V, E, cases, solver=None, bc=None, geom=None,
+                     stresses=False, estimates=False, problem=None):
+    """
+    Solve several load cases (see load_vector) on one mesh. The stiffness
+    matrix is assembled, reduced and factorized once and all right hand
+    sides are solved as a block.
+    Returns U with shape (2*nv, ncases) and a dict that holds, when
+    asked for, the von Mises stresses (ne, ncases) and the error
+    indicators eta_K (ne, ncases) and eta (ncases,). problem (optional)
+    gives the material and the clamped edge; its point load is not
+    applied, the loads come from the cases.
+    """
+    if geom is None:
+        geom = MeshGeometry(V, E)
+    if problem is None:
+        problem = DEFAULT_PROBLEM
+    if solver is None:
+        solver = LinearSolver('direct')
+    if bc is None:
+        bc = DirichletBC.from_vertices(
+            geom.locator.boundary_vertices_on(*problem.clamped))
+    
+    Ktan, _ = assemble_stiffness(V, E, problem.C(), geom=geom)
+    Fb = body_force(E, V, geom=geom, problem=problem)
+    F = np.column_stack([load_vector(V, E, case, Fb, geom) for case in cases])
+    
+    solver.setup(bc.reduce(Ktan))
+    U = np.zeros_like(F)
+    U[bc.free] = solver.solve(F[bc.free])
+    
+    results = {'solver': dict(solver.stats)}
+    if stresses:
+        results['von_mises'] = np.column_stack(
+            [post_process(V, E, U[:, k], geom=geom,
+                          problem=problem)['von_mises']
+             for k in range(len(cases))])
+    if estimates:
+        est = [error_estimator(V, E, U[:, k], geom, problem=problem,
+                               theta=None)
+               for k in range(len(cases))]
+        results['eta_K'] = np.column_stack([e[1] for e in est])
+        results['eta'] = np.array([e[2] for e in est])
+    return U, results
+
+# Quantities of interest of the L-domain for goal-oriented refinement:
+# the mean deflection around the load point and the mean von Mises
+# stress around the re-entrant corner (the pointwise values are singular
+# under a point load and at the corner)
+TIP_DEFLECTION = ('displacement', 1, 0.5, 1, 0.05)
+CORNER_STRESS = ('stress', 0.5, 0.5, 0.05, 'von_mises')
+
+def _von_mises_grad(sigma, mu, cond):
+    # von Mises stress of the rows of sigma (n, 3) and its gradient
+    sxx, syy, sxy = sigma.T
+    c = mu if cond == 0 else 0.0
+    szz = c*(sxx+syy)
+    vm = np.sqrt(0.5*((sxx-syy)**2 + (syy-szz)**2 + (szz-sxx)**2)
+                 + 3*sxy**2)
+    d_vm2 = np.stack(((sxx-syy) - c*(syy-szz) + (c-1)*(szz-sxx),
+                      (syy-sxx) + (1-c)*(syy-szz) + c*(szz-sxx),
+                      6*sxy), axis=1)
+    return vm, d_vm2/(2*np.maximum(vm, 1e-300))[:, None]
+
+def goal_functional(V, E, goal, u, geom=None, problem=None):
+    """
+    Value J(u) of a quantity of interest and its derivative j (2*nv,),
+    J(u + v) ~ J(u) + j.v (exact for the linear ones). goal is
+        ('displacement', x, y, dir[, r]) - displacement in direction
+                                      dir (0: x, 1: y) at (x, y), or with
+                                      r its mean over the elements near
+                                      (x, y), as for the stress
+        ('stress', x, y, r, comp)   - area weighted mean of the element
+                                      stress comp ('xx', 'yy', 'xy' or
+                                      'von_mises', linearized at u) over
+                                      the elements with centroid within
+                                      r of (x, y), or the element
+                                      containing (x, y) if there are none
+    """
+    return _goal_terms(V, E, goal, u, geom, problem)[:2]
+
+def _goal_terms(V, E, goal, u, geom=None, problem=None):
+    # J, j and j as a volume load (f, s) for error_estimator: the means
+    # over elements are int f.v (displacement) or int s:eps(v) (stress)
+    # with f, s constant on the elements; the point value has no density
+    if geom is None:
+        geom = MeshGeometry(V, E)
+    if problem is None:
+        problem = DEFAULT_PROBLEM
+    j = np.zeros(2*len(V))
+    if goal[0] not in ('displacement', 'stress'):
+        raise ValueError('Unknown quantity of interest: %s' % (goal[0],))
+    if goal[0] == 'displacement' and len(goal) == 4:
+        _, x, y, load_dir = goal
+        dofs, w = geom.locator.point_load(x, y, load_dir)
+        j[dofs] = w
+        return float(w @ u[dofs]), j, None
+    x, y, r = goal[1], goal[2], goal[4 if goal[0] == 'displacement' else 3]
+    els = np.flatnonzero(np.hypot(*(geom.centroids - (x, y)).T) <= r)
+    if len(els) == 0:
+        els = geom.locator.locate((x, y))[0]
+    a = geom.area[els]/geom.area[els].sum()
+    if goal[0] == 'displacement':
+        f = np.zeros((len(E), 2))
+        f[els, goal[3]] = 1/geom.area[els].sum()
+        # element means of the shape functions: 1/3 at the corners, and
+        # 0 at the corners and 1/3 at the midpoints on six-node elements
+        Nbar = np.full(3, 1/3) if geom.order == 1 else np.r_[np.zeros(3),
+                                                             np.full(3, 1/3)]
+        dofs = 2*E[els] + goal[3]
+        j += np.bincount(dofs.ravel(), weights=np.outer(a, Nbar).ravel(),
+                         minlength=len(j))
+        return float(j @ u), j, (f, None)
+    comp = goal[4]
+    if geom.order == 2:
+        w = TRIANGLE_QUADRATURE[2][1]
+        B = np.einsum('q,eqij->eij', w, geom.B[els])/w.sum()
+    else:
+        B = geom.B[els]
+    C = problem.C()
+    dofs = geom.dofs[els]
+    sigma = np.einsum('eij,ej->ei', B, u[dofs]) @ C.T
+    if comp == 'von_mises':
+        val, grad = _von_mises_grad(sigma, problem.mu, problem.cond)
+    else:
+        k = {'xx': 0, 'yy': 1, 'xy': 2}[comp]
+        val = sigma[:, k]
+        grad = np.zeros_like(sigma)
+        grad[:, k] = 1.0
+    je = a[:, None]*np.einsum('eki,ek->ei', B, grad @ C)
+    j += np.bincount(dofs.ravel(), weights=je.ravel(), minlength=len(j))
+    s = np.zeros((len(E), 3))
+    s[els] = (a/geom.area[els])[:, None]*(grad @ C)
+    return float(a @ val), j, (None, s)
+
+def dwr_indicators(V, E, u, z, geom=None, problem=None):
+    """
+    Dual weighted residual contributions rho_K of linear elements: the
+    residuals of u (gravity in the elements, the traction jumps over
+    the edges, the point load) tested against z+ - z, where z is the
+    adjoint solution and z+ its quadratic reconstruction. z+ keeps the
+    vertex values of z; at an edge midpoint it takes the value of the
+    quadratic along the edge with the recovered (area averaged) vertex
+    gradients of z at both ends. z+ - z is thus a sum of edge bubbles,
+    integrated exactly, and no second solve is needed. sum(rho_K)
+    estimates J(u_exact) - J(u), |rho_K| are the indicators.
+    """
+    if geom is None:
+        geom = MeshGeometry(V, E)
+    if problem is None:
+        problem = DEFAULT_PROBLEM
+    if geom.order != 1:
+        raise ValueError('dwr_indicators needs linear elements')
+    nv = len(V)
+    edges, el2edge, edge2el = geom.edges, geom.el2edge, geom.edge2el
+    is_boundary = geom.locator.boundary_vertices_on(*problem.clamped)
+    
+    # element gradients of z (ne, component, direction), averaged onto
+    # the vertices with the element areas as weights
+    dN = np.stack((geom.B[:, 0, 0::2], geom.B[:, 1, 1::2]), axis=2)
+    gz = np.einsum('eid,eic->ecd', dN, z.reshape(-1, 2)[E])
+    wa = np.repeat(geom.area, 3)
+    G = np.stack([np.bincount(E.ravel(), wa*np.repeat(gz[:, c, d], 3),
+                              minlength=nv)
+                  for c in range(2) for d in range(2)], axis=1)
+    G = G.reshape(nv, 2, 2)/np.maximum(
+        np.bincount(E.ravel(), wa, minlength=nv), 1e-300)[:, None, None]
+    
+    # midpoint values of z+ - z, q(1/2) - (q(0)+q(1))/2 = (q'(0)-q'(1))/8
+    t = V[edges[:, 1]] - V[edges[:, 0]]
+    d = np.einsum('ecd,ed->ec', G[edges[:, 0]] - G[edges[:, 1]], t)/8
+    clamped = is_boundary[edges].all(axis=1)
+    d[clamped] = 0.0
+    
+    # traction jumps [[sigma n]] with n the outward normal of edge2el[:, 0]
+    sigma = np.einsum('eij,ej->ei', geom.B, u[geom.dofs]) @ problem.C().T
+    n = geom.normals
+    def traction(el):
+        s = sigma[el]
+        return np.stack((s[:, 0]*n[:, 0] + s[:, 2]*n[:, 1],
+                         s[:, 2]*n[:, 0] + s[:, 1]*n[:, 1]), axis=1)
+    interior = edge2el[:, 1] >= 0
+    other = np.where(interior, edge2el[:, 1], edge2el[:, 0])
+    jump = traction(edge2el[:, 0]) - interior[:, None]*traction(other)
+    mid = V[edges].mean(axis=1)
+    jump *= np.sign(np.sum((mid - geom.centroids[edge2el[:, 0]])*n,
+                           axis=1))[:, None]
+    w = np.where(interior, 0.5, 1.0)
+    w[~interior & clamped] = 0.0
+    
+    # a bubble 4 l_a l_b integrates to |K|/3 over K and 2|e|/3 along e
+    f = np.array([0.0, -problem.rho*problem.g])
+    edge_term = w*np.sum(jump*d, axis=1)*2*geom.edge_len/3
+    rho_K = (geom.area/3*(d[el2edge] @ f).sum(axis=1)
+             - edge_term[el2edge].sum(axis=1))
+    
+    # the point load, unless on a vertex where z+ - z vanishes
+    x, y, load_dir, value = problem.load
+    if geom.locator.nearest_vertex((x, y))[1][0] >= geom.locator.tol:
+        el, lam = geom.locator.locate((x, y))
+        lam = lam[0]
+        bubbles = 4*lam*np.roll(lam, -1)
+        rho_K[el[0]] += value*bubbles @ d[el2edge[el[0]], load_dir]
+    return rho_K
+
+@profiled('goal_estimator')
+def goal_estimator(V, E, u, goals, solver, geom=None, pool=None,
+                   problem=None, bc=None, eta_u=None, method=None):
+    """
+    Goal-oriented indicators for one quantity of interest (see
+    goal_functional) or a list of them, for the solution u that solver
+    just computed in FEM_sol: the adjoint problems K z = j are solved
+    with the solver as it was set up there (same factorization or
+    preconditioner), all goals in one block solve. method is
+        'dwr'     - dual weighted residual, eta_K = |rho_K| from
+                    dwr_indicators; the default on linear elements
+        'product' - products of the primal and adjoint residual
+                    indicators, eta_K = sqrt(eta_K(u) eta_K(z)), as in
+                    Mommer and Stevenson; the default on six-node
+                    elements. The adjoint residual has the goal as its
+                    load (its density over the elements, the point
+                    value has none) in place of gravity.
+    eta_u (optional) are the error_estimator indicators of u when
+    already computed ('product' only).
+    Returns the indicators for marking (with several goals the sum of
+    the per-goal indicators, each normalized by its total) and a list
+    of dicts with 'J', 'eta' (the sum of the goal's indicators) and the
+    adjoint solution 'z' per goal, with 'dwr' also 'error', the signed
+    estimate of J(u_exact) - J(u).
+    """
+    if geom is None:
+        geom = MeshGeometry(V, E)
+    if problem is None:
+        problem = DEFAULT_PROBLEM
+    if bc is None:
+        bc = DirichletBC.from_vertices(
+            geom.locator.boundary_vertices_on(*problem.clamped))
+    single = isinstance(goals[0], str)
+    if single:
+        goals = [goals]
+    values, js, loads = zip(*[_goal_terms(V, E, q, u, geom, problem)
+                              for q in goals])
+    Z = np.zeros((2*len(V), len(goals)))
+    Z[bc.free] = solver.solve(np.column_stack(js)[bc.free]
+                              ).reshape(len(bc.free), -1)
+    
+    if method is None:
+        method = 'dwr' if geom.order == 1 else 'product'
+    if method not in ('dwr', 'product'):
+        raise ValueError('Unknown goal estimator: %s' % method)
+    if method == 'product' and eta_u is None:
+        eta_u = error_estimator(V, E, u, geom, pool, problem, None)[1]
+    dual = problem.replace(rho=0)
+    results = []
+    eta_K = np.zeros(len(E))
+    for k, J in enumerate(values):
+        res = {'goal': goals[k], 'J': J, 'z': Z[:, k]}
+        if method == 'dwr':
+            rho_K = dwr_indicators(V, E, u, Z[:, k], geom, problem)
+            eta_k = np.abs(rho_K)
+            res['error'] = float(rho_K.sum())
+        else:
+            eta_z = error_estimator(V, E, Z[:, k], geom, pool, dual, None,
+                                    loads[k])[1]
+            eta_k = np.sqrt(eta_u*eta_z)
+        total = eta_k.sum()
+        res['eta'] = float(total)
+        results.append(res)
+        eta_K += eta_k if single else eta_k/max(total, 1e-300)
+    return eta_K, results
+
+@profiled('hierarchy')
+def multigrid_prolongations(mesh, ratio=1.0):
+    """
+    DOF prolongations [P_0, P_1, ...] between meshes of the refinement
+    history of the AdaptiveMesh mesh, finest (the current mesh) first:
+    P_l (2 nv_l, 2 nv_(l+1)). By default every earlier mesh is a level,
+    which is what locally refined hierarchies need (a coarse level that
+    skips refinements near the singularity corrects that region
+    poorly); with ratio > 1 a level is kept only when it has at most
+    1/ratio of the vertices of the level above, e.g. 4 for W-cycles,
+    which refuse levels that do not at least halve the unknowns.
+    """
+    levels = [mesh.nv]
+    for h in reversed(mesh.history):
+        if h['nv'] < levels[-1] and h['nv']*ratio <= levels[-1]:
+            levels.append(h['nv'])
+    I2 = sparse.identity(2, format='csr')
+    return [sparse.kron(mesh.prolongation(nc, nf), I2, format='csr')
+            for nf, nc in zip(levels[:-1], levels[1:])]
+
+@profiled('mark')
+def mark_elements(eta_K, strategy='doerfler', theta=0.5, e_rel=None,
+                  threshold=0.1):
+    """
+    Select elements for refinement from the indicators eta_K.
+        'doerfler'  - smallest set whose indicators sum to at least
+                      theta*sum(eta_K) (bulk criterion)
+        'max'       - every element with eta_K >= theta*max(eta_K)
+        'threshold' - elements with relative error e_rel > threshold
+    Nothing is marked when all indicators are zero.
+    """
+    if strategy in ('doerfler', 'max') and not np.any(eta_K > 0):
+        marked = np.array([], dtype=np.int64)
+    elif strategy == 'doerfler':
+        order = np.argsort(eta_K)[::-1]
+        total = np.cumsum(eta_K[order])
+        n = np.searchsorted(total, theta*total[-1]) + 1
+        marked = np.sort(order[:n])
+    elif strategy == 'max':
+        marked = np.flatnonzero(eta_K >= theta*eta_K.max())
+    elif strategy == 'threshold':
+        marked = np.flatnonzero(e_rel > threshold)
+    else:
+        raise ValueError('Unknown marking strategy: %s' % strategy)
+    gauge('marked_elements', len(marked))
+    return marked
+
+@profiled()
+def adapt(V, E, target_eta=None, max_dofs=None, max_time=None, max_cycles=10,
+          strategy='doerfler', theta=0.5, solver=None, log_file=None,
+          pool=None, order=1, mesh=None, U0=None, checkpoint=None,
+          problem=None, matrix_free=None, goal=None, threshold=0.1,
+          ordering=None, resume=None, mg_ratio=None):
+    """
+    Adaptive solve -> estimate -> mark -> refine loop starting from the
+    mesh (V, E). Stops at the first of: global eta <= target_eta, number
+    of DOFs >= max_dofs, wall clock >= max_time seconds, max_cycles, or
+    no element marked ('no_marked'). strategy, theta and threshold go
+    to mark_elements; the relative errors e_rel the 'threshold' strategy
+    compares are a few percent at most on the L-domain.
+    The mesh is refined in place by newest vertex bisection, element
+    blocks of unchanged elements are reused and each solve is warm started
+    from the previous solution. The warm start only saves iterations
+    when the solver stops relative to the residual of the initial guess,
+    e.g. LinearSolver('cg', 'jacobi', rtol0=1e-2), see LinearSolver.
+    
+    Returns the AdaptiveMesh, the final displacement vector and the cycle
+    log: one dict per cycle with DOFs, eta, marked elements, solver
+    iterations and the timings of each phase. With log_file the records
+    are also appended to that file as JSON lines. pool (optional) is a
+    FEM_parallel.ElementPool for the element kernels.
+    With order=2 every cycle solves on quadratic_mesh(mesh.V, mesh.E),
+    without element reuse or warm start, and U holds the vertex values
+    followed by the edge midpoints of that mesh.
+    
+    checkpoint (optional) is a FEM_io file written at the end of every
+    cycle with the log so far (meta 'log' and 'order') and the solved
+    state of that cycle: its displacements U and indicators eta_K.
+    After the last cycle the mesh is the solved one. Otherwise it is the
+    refined mesh to solve next, with its warm start U0 (linear
+    elements); the solved mesh is then (V[:nv], E_solved), nv from the
+    cycle's log record (U on quadratic_mesh of it with order=2).
+    To continue an interrupted run pass the checkpoint (its path or the
+    loaded FEM_io.Checkpoint) as resume, with the same arguments
+    otherwise: V and E are then ignored, the cycles are numbered on from
+    the saved log, max_cycles counts the saved cycles as well and the
+    returned log holds both, so the run ends as the uninterrupted one
+        adapt(None, None, max_cycles=6, checkpoint=path, resume=path)
+    A finished run continues the same way (e.g. with a larger
+    max_cycles), solving its last cycle again.
+    A plain AdaptiveMesh (V and E are then ignored) and a warm start U0
+    can also be passed as mesh and U0.
+    problem (optional) is the Problem solved in every cycle.
+    matrix_free ('cached' or 'geometry') solves without assembling the
+    global matrix, see FEM_sol; 'cached' applies the element blocks the
+    cycles already keep. ordering ('rcm' or 'nd') is the DOF order of
+    each solve, see FEM_sol.
+    With the 'multigrid' solver or the 'gmg' preconditioner the meshes
+    of the refinement history so far are the multigrid levels (linear
+    elements only, on six-node elements the coarsest level is the
+    whole problem). mg_ratio is the ratio of multigrid_prolongations,
+    by default 1 (every mesh) for V-cycles and 4 for W-cycles, which
+    need coarser steps, see Multigrid.
+    goal (optional) is a quantity of interest or a list of them (see
+    goal_functional, e.g. TIP_DEFLECTION) that drives the refinement:
+    the elements are marked on the goal_estimator indicators, eta and
+    target_eta refer to its estimate of the goal error and the log has
+    'goals' with J and eta (and the signed error on linear elements).
+    With several goals of different units eta is the largest relative
+    estimate eta/|J| over the goals.
+    """
+    if solver is None:
+        solver = LinearSolver('cg', 'jacobi')
+    log = []
+    if checkpoint is not None or resume is not None:
+        import FEM_io
+    if resume is not None:
+        if not isinstance(resume, FEM_io.Checkpoint):
+            resume = FEM_io.load_checkpoint(resume)
+        if resume.meta.get('order', order) != order:
+            raise ValueError('The checkpoint is of an order %d run'
+                             % resume.meta['order'])
+        log = list(resume.meta.get('log', []))
+        U0 = resume['U0'] if 'U0' in resume else None
+        if log and log[-1].get('stop') is not None:
+            # a finished run, its last cycle is solved again (from its
+            # solution) and the run goes on if the stop no longer holds
+            log.pop()
+            U0 = resume['U'] if order == 1 else None
+        if len(log) >= max_cycles:
+            raise ValueError('max_cycles=%d, the checkpoint already has %d '
+                             'cycles' % (max_cycles, len(log)))
+        mesh = resume.adaptive_mesh()
+    if mesh is None:
+        mesh = AdaptiveMesh(V, E)
+    geom = MeshGeometry(mesh.V, mesh.E)
+    cache = AssemblyCache(problem=problem)
+    changed = None
+    if U0 is not None:
+        U0 = np.array(U0)
+    t_start = time.perf_counter()
+    
+    for cycle in range(len(log), max_cycles):
+        rec = {'cycle': cycle, 'nv': mesh.nv, 'ne': mesh.ne,
+               'dofs': 2*mesh.nv}
+        
+        t0 = time.perf_counter()
+        if order == 2:
+            V2, E2 = quadratic_mesh(mesh.V, mesh.E)
+            geom2 = MeshGeometry(V2, E2)
+            rec['dofs'] = 2*len(V2)
+            U = FEM_sol(V2, E2, solver=solver, geom=geom2, pool=pool,
+                        problem=problem, matrix_free=matrix_free,
+                        ordering=ordering)
+            stats = dict(solver.stats)
+            t1 = time.perf_counter()
+            _, eta_K, eta, e_rel, _ = error_estimator(V2, E2, U, geom2, pool,
+                                                      problem, None)
+            if goal is not None:
+                eta_K, goals = goal_estimator(V2, E2, U, goal, solver, geom2,
+                                              pool, problem, eta_u=eta_K)
+        else:
+            prolongations = None
+            if solver.method == 'multigrid' or solver.precond == 'gmg':
+                ratio = mg_ratio
+                if ratio is None:
+                    W = solver.precond_kwargs.get('cycle', 'V') == 'W'
+                    ratio = 4.0 if W else 1.0
+                prolongations = multigrid_prolongations(mesh, ratio)
+            U = FEM_sol(mesh.V, mesh.E, solver=solver, U0=U0, cache=cache,
+                        changed=changed, geom=geom, pool=pool,
+                        problem=problem, matrix_free=matrix_free,
+                        prolongations=prolongations, ordering=ordering)
+            stats = dict(solver.stats)
+            t1 = time.perf_counter()
+            _, eta_K, eta, e_rel, _ = error_estimator(mesh.V, mesh.E, U,
+                                                      geom, pool, problem,
+                                                      None)
+            if goal is not None:
+                eta_K, goals = goal_estimator(mesh.V, mesh.E, U, goal, solver,
+                                              geom, pool, problem,
+                                              eta_u=eta_K)
+        if goal is not None:
+            if len(goals) == 1:
+                eta = goals[0]['eta']
+            else:
+                # the goals have different units, compare relative errors
+                eta = max(q['eta']/max(abs(q['J']), 1e-300) for q in goals)
+            rec['goals'] = [{k: q[k] for k in ('J', 'eta', 'error') if k in q}
+                            for q in goals]
+        t2 = time.perf_counter()
+        rec.update({'eta': float(eta),
+                    'iterations': stats.get('iterations'),
+                    'setup_time': stats.get('setup_time'),
+                    'solve_time': stats.get('solve_time'),
+                    't_solve': t1-t0, 't_estimate': t2-t1})
+        
+        stop = None
+        if target_eta is not None and eta <= target_eta:
+            stop = 'target_eta'
+        elif max_dofs is not None and rec['dofs'] >= max_dofs:
+            stop = 'max_dofs'
+        elif max_time is not None and t2-t_start >= max_time:
+            stop = 'max_time'
+        elif cycle == max_cycles-1:
+            stop = 'max_cycles'
+        
+        if stop is None:
+            t2 = time.perf_counter()
+            marked = mark_elements(eta_K, strategy, theta, e_rel, threshold)
+            t3 = time.perf_counter()
+            rec.update({'marked': len(marked), 't_mark': t3-t2})
+            if len(marked) == 0:
+                stop = 'no_marked'
+        
+        solved = {}
+        if checkpoint is not None and stop is None:
+            # refine() works in place, keep the elements that were solved
+            solved['E_solved'] = mesh.E.copy()
+        if stop is None:
+            with phase('refine'):
+                changed = mesh.refine(marked)
+                geom.invalidate(mesh.V, mesh.E)
+                U0 = mesh.prolongate(U) if order == 1 else None
+            t4 = time.perf_counter()
+            rec.update({'changed': len(changed), 't_refine': t4-t3})
+        rec['t_total'] = time.perf_counter()-t_start
+        rec['stop'] = stop
+        log.append(rec)
+        if checkpoint is not None:
+            t5 = time.perf_counter()
+            if U0 is not None and stop is None:
+                solved['U0'] = U0
+            FEM_io.save_checkpoint(checkpoint, mesh=mesh, U=U, eta_K=eta_K,
+                                   meta={'log': log, 'order': order},
+                                   **solved)
+            rec['t_checkpoint'] = time.perf_counter()-t5
+        if log_file is not None:
+            with open(log_file, 'a') as fh:
+                fh.write(json.dumps(rec) + '\n')
+        if stop is not None:
+            break
+    return mesh, U, log
+
  
 if __name__ == '__main__':
+    # plotting is only needed here, the solver imports without it
+    import FEM_plots
+    FEM_plots.close_all()
     
     #from tempfile import TemporaryFile
     #u_exact_val = TemporaryFile()
@@ -649,78 +1774,53 @@ if __name__ == '__main__':
     
     
     # Solve FEM problem to get structural displacements
-    U = FEM_sol(V,E)
+    geom = MeshGeometry(V, E)
+    U = FEM_sol(V,E, geom=geom)
     print('original mesh d.o.f=',len(U))
     
     #np.save(u_exact_val, U)
     # Get the distribution of internal stress           
-    Fint, norm_f_old = int_stress(E,V,U)
-    
-    # Get deformed coordinates to plot displaced mesh
-    U_mat = U.reshape((nv,2))
-    X_new = X+ U_mat[:,0]
-    Y_new = Y+ U_mat[:,1]
-    #print(U_mat)
+    Fint, norm_f_old = int_stress(E,V,U, geom)
     
     # Plot original mesh and deformed mesh
-    plt.figure(1,figsize=(7,7))
-    plt.gca().set_aspect("equal")
-    plt.triplot(X, Y, E)
-    plt.triplot(X_new, Y_new, E)
-    plt.title('Undeformed and deformed FEA meshes=',y=1.05, fontsize=10)
-    plt.xlabel('x')
-    plt.ylabel('y')
-    plt.savefig('Figs/Undeformed and deformed FEA meshes.png')
+    FEM_plots.plot_mesh(V, E, U, 'Undeformed and deformed FEA meshes=',
+                        'Figs/Undeformed and deformed FEA meshes.png', 1)
 
     
     #Plot Internal stress distribution
-   
-    fig = plt.figure(2,figsize=(8,8))
-    ax = fig.add_subplot(projection='3d')
-    ax.plot_trisurf(X, Y, Fint, triangles=E, cmap=plt.cm.jet, linewidth=0.2)
-    plt.title('Internal stress distribution over domain',y=1.05, fontsize=10)
-    plt.xlabel('x')
-    plt.ylabel('y')
-    plt.savefig('Figs/Internal stress distribution over domain.png')
+    FEM_plots.plot_field(V, E, Fint, 'Internal stress distribution over domain',
+                         'Figs/Internal stress distribution over domain.png', 2)
     
     
     
     # Call error estimator and mark the triangles for refinement
-    mark,_,eta,_,esz=error_estimator(V,E, U)
+    mark,_,eta,_,esz=error_estimator(V,E, U, geom)
     
 
     
-    # Generate the refined mesh
+    # Adaptive solve -> estimate -> mark -> refine cycles
     t=0
-    #for t in range(0,5):
-    V_new, E_new = make_mesh(1,mark,t)
-
-    # Solve FEM on new mesh
-    U_new = FEM_sol(V_new,E_new)
+    mesh, U_new, amr_log = adapt(V, E, max_cycles=5, strategy='doerfler',
+                                 theta=0.5)
+    for rec in amr_log:
+        print('cycle', rec['cycle'], 'd.o.f=', rec['dofs'], 'eta=', rec['eta'],
+              'cg iterations=', rec['iterations'])
+    V_new, E_new = mesh.V, mesh.E
+    geom_new = MeshGeometry(V_new, E_new)
     print('refined mesh d.o.f=',len(U_new))
     # Get the new internal stress distribution
-    Fint_new,norm_f_new = int_stress(E_new,V_new,U_new)
-    X_new, Y_new = V_new[:, 0], V_new[:, 1]
-    mark,_,eta,_,esz=error_estimator(V_new,E_new, U_new)
+    Fint_new,norm_f_new = int_stress(E_new,V_new,U_new, geom_new)
 
     # Plot new mesh
-    plt.figure(t*3,figsize=(7,7))
-    plt.gca().set_aspect("equal")
-    plt.triplot(X_new, Y_new, E_new)
-    plt.title('Adaptive mesh refinement=',y=1.05, fontsize=10)
-    plt.xlabel('x')
-    plt.ylabel('y')
-    plt.savefig('Figs/Adaptive mesh refinement.png')
+    FEM_plots.plot_mesh(V_new, E_new, None, 'Adaptive mesh refinement=',
+                        'Figs/Adaptive mesh refinement.png', t*3)
     
     
     #Plot new internal stress distribution
-    fig = plt.figure(4,figsize=(8,8))
-    ax = fig.add_subplot(projection='3d')
-    ax.plot_trisurf(X_new, Y_new, Fint_new, triangles=E_new, cmap=plt.cm.jet, linewidth=0.2)
-    plt.title('Internal stress distribution over refined mesh',y=1.05, fontsize=10)
-    plt.xlabel('x')
-    plt.ylabel('y')
-    plt.savefig('Figs/Internal stress distribution over refined mesh.png')
+    FEM_plots.plot_field(V_new, E_new, Fint_new,
+                         'Internal stress distribution over refined mesh',
+                         'Figs/Internal stress distribution over refined mesh.png',
+                         4)
     
     print('L_inf norm for original mesh', norm_f_old)
     print('L_inf norm for refined mesh', norm_f_new)
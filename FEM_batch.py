@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter sweeps of the FEA problem over a process pool
+
+expand_grid() turns a base Problem and a grid of parameter values into
+the list of cases. run_batch() groups the cases by mesh (outline and
+mesh size), meshes every group once in the calling process and sends
+the mesh with chunks of its cases to the workers. A chunk shares one
+MeshGeometry, and its cases with the same material and clamped edge
+share one assembled and factorized stiffness matrix, solved for all
+their loads as a block. Every case is appended to the output file as a
+JSON line as soon as its chunk completes.
+
+    python FEM_batch.py sweep.json results.jsonl --workers 8
+
+with sweep.json like {"base": {"size": 0.005},
+                      "grid": {"YM": [5, 10, 20], "mu": [0.2, 0.3]}}
+
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import FEM_AMR_L_dom as fem
+from FEM_solvers import LinearSolver
+
+
+def expand_grid(grid, base=None):
+    """
+    All combinations of the parameter values in grid ({name: [values]})
+    applied to the base Problem (default the original one).
+    """
+    base = base or fem.DEFAULT_PROBLEM
+    names = list(grid)
+    return [base.replace(**dict(zip(names, values)))
+            for values in itertools.product(*grid.values())]
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+def solve_chunk(V, E, problems, cases, estimate=True, solver=None):
+    """
+    Solve the problems (all on the mesh (V, E)) and return one result
+    dict per case; cases are the case numbers reported with them.
+    """
+    if solver is None:
+        solver = LinearSolver('direct')
+    geom = fem.MeshGeometry(V, E)
+    groups = {}
+    for k, p in enumerate(problems):
+        key = (p.YM, p.mu, p.cond, tuple(tuple(q) for q in p.clamped))
+        groups.setdefault(key, []).append(k)
+
+    results = []
+    for members in groups.values():
+        t0 = time.perf_counter()
+        first = problems[members[0]]
+        K, _ = fem.assemble_stiffness(V, E, first.C(), geom=geom)
+        bc = fem.DirichletBC.from_vertices(
+            geom.locator.boundary_vertices_on(*first.clamped))
+        solver.setup(bc.reduce(K))
+        F = np.column_stack([fem.load_vector(V, E, {'point': [p.load]},
+                                             geom=geom, problem=p)
+                             for p in (problems[k] for k in members)])
+        U = np.zeros_like(F)
+        U[bc.free] = solver.solve(F[bc.free])
+        t_group = time.perf_counter()-t0
+
+        for j, k in enumerate(members):
+            t0 = time.perf_counter()
+            p = problems[k]
+            u = U[:, j]
+            post = fem.post_process(V, E, u, geom=geom, problem=p)
+            # displacement at the load point, in the load direction
+            dofs, w = geom.locator.point_load(*p.load[:3])
+            rec = {'case': cases[k], 'params': p.params(), 'nv': len(V),
+                   'ne': len(E), 'dofs': 2*len(V),
+                   'load_disp': float(w @ u[dofs]),
+                   'max_disp': float(np.abs(u).max()),
+                   'max_von_mises': float(post['max_von_mises']),
+                   'norm_fint': float(post['norm_fint'])}
+            if estimate:
+                rec['eta'] = float(fem.error_estimator(V, E, u, geom,
+                                                       problem=p,
+                                                       theta=None)[2])
+            rec['time'] = t_group/len(members) + time.perf_counter()-t0
+            results.append(rec)
+    return results
+
+def _chunks(seq, size):
+    return [seq[i:i+size] for i in range(0, len(seq), size)]
+
+def run_batch(problems, out=None, workers=None, estimate=True, solver=None,
+              chunk_size=None):
+    """
+    Solve all problems and return their results ordered by case number
+    (the index in problems). With out, each result is also appended to
+    that file as a JSON line as soon as it is available. workers=1 runs
+    in the calling process. chunk_size limits the cases per task, by
+    default the cases of a mesh are spread evenly over the workers.
+    """
+    workers = workers or os.cpu_count() or 1
+    by_mesh = {}
+    for i, p in enumerate(problems):
+        by_mesh.setdefault(p.mesh_key(), []).append(i)
+
+    fh = open(out, 'a') if out is not None else None
+    results = []
+    def collect(recs):
+        results.extend(recs)
+        if fh is not None:
+            for rec in recs:
+                fh.write(json.dumps(rec, default=_json_default) + '\n')
+            fh.flush()
+
+    try:
+        if workers == 1:
+            for idx in by_mesh.values():
+                V, E = problems[idx[0]].make_mesh()
+                collect(solve_chunk(V, E, [problems[i] for i in idx], idx,
+                                    estimate, solver))
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                futures = []
+                for idx in by_mesh.values():
+                    V, E = problems[idx[0]].make_mesh()
+                    size = chunk_size or -(-len(idx) // workers)
+                    for part in _chunks(idx, size):
+                        futures.append(pool.submit(
+                            solve_chunk, V, E, [problems[i] for i in part],
+                            part, estimate, solver))
+                for fut in as_completed(futures):
+                    collect(fut.result())
+    finally:
+        if fh is not None:
+            fh.close()
+    return sorted(results, key=lambda rec: rec['case'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('sweep', help='JSON file with "base" and "grid"')
+    parser.add_argument('out', help='JSON lines output, appended to')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=None)
+    parser.add_argument('--no-estimate', action='store_true')
+    args = parser.parse_args()
+
+    with open(args.sweep) as fh:
+        sweep = json.load(fh)
+    problems = expand_grid(sweep.get('grid', {}),
+                           fem.Problem(**sweep.get('base', {})))
+    t0 = time.perf_counter()
+    results = run_batch(problems, args.out, args.workers,
+                        not args.no_estimate, chunk_size=args.chunk_size)
+    print(len(results), 'cases in %.3gs' % (time.perf_counter()-t0))
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the FEM pipeline on the L-domain
+
+Times make_mesh, FEM_Ktan_Fint, body_force, FEM_sol, int_stress and
+error_estimator separately over a sweep of mesh sizes, once on
+quasi-uniform meshes from make_mesh and once along an adaptive
+refinement run, and records the peak memory of every phase. The
+results are written as JSON together with the scaling exponent of
+each phase (slope of log time over log DOFs).
+
+    python FEM_bench.py --max-dofs 1e6 --repeat 3 --out bench.json
+
+"""
+import argparse
+import json
+import os
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+import scipy
+
+import FEM_AMR_L_dom as fem
+from FEM_mesh import AdaptiveMesh
+from FEM_solvers import LinearSolver
+
+PHASES = ('make_mesh', 'FEM_Ktan_Fint', 'body_force', 'FEM_sol',
+          'int_stress', 'error_estimator')
+
+
+def time_call(fn, repeat=1):
+    """Best wall clock time of repeat calls of fn() and its last result."""
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter()-t0)
+    return out, best
+
+def peak_memory(fn):
+    """Peak memory (MB) allocated while running fn(), via tracemalloc."""
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak/2**20
+
+def bench_mesh(V, E, repeat=1, memory=True, solver=None, make=None):
+    """
+    Time every phase on the mesh (V, E). make (optional) is a function
+    returning the mesh, timed as the make_mesh phase. No MeshGeometry is
+    shared between the calls, so each phase pays for its own geometry.
+    Returns one record with the mesh size, the times t_<phase> (s), the
+    peaks mem_<phase> (MB), the L_inf displacement and the estimate eta,
+    together with the solution U and the indicators eta_K.
+    """
+    nv = len(V)
+    if solver is None:
+        solver = LinearSolver('direct')
+    U = np.zeros(2*nv)
+    # U is looked up when called, int_stress and error_estimator run
+    # after FEM_sol and see its solution
+    calls = {
+        'make_mesh': make,
+        'FEM_Ktan_Fint': lambda: fem.FEM_Ktan_Fint(V, E, 1, 0.5, U, 1),
+        'body_force': lambda: fem.body_force(E, V),
+        'FEM_sol': lambda: fem.FEM_sol(V, E, solver=solver),
+        'int_stress': lambda: fem.int_stress(E, V, U),
+        'error_estimator': lambda: fem.error_estimator(V, E, U),
+        }
+
+    rec = {'nv': nv, 'ne': len(E), 'dofs': 2*nv}
+    for name in PHASES:
+        if calls[name] is None:
+            continue
+        out, rec['t_'+name] = time_call(calls[name], repeat)
+        if memory:
+            rec['mem_'+name] = peak_memory(calls[name])
+        if name == 'FEM_sol':
+            U = out
+            rec['iterations'] = solver.stats.get('iterations')
+        elif name == 'error_estimator':
+            eta_K = out[1]
+            rec['eta'] = float(out[2])
+    rec['L_inf'] = float(np.abs(U).max())
+    return rec, U, eta_K
+
+def dof_sizes(min_dofs, max_dofs, per_decade=2):
+    """Target DOF counts spaced evenly in log scale."""
+    n = int(round(np.log10(max_dofs/min_dofs)*per_decade)) + 1
+    return np.geomspace(min_dofs, max_dofs, n)
+
+def uniform_sweep(min_dofs=1e2, max_dofs=1e5, per_decade=2, repeat=1,
+                  memory=True, solver=None, verbose=False):
+    """
+    Benchmark quasi-uniform meshes from make_mesh. The element size is
+    chosen from the target DOFs (make_mesh gives about 0.75/size DOFs).
+    verbose prints a line per mesh.
+    """
+    records = []
+    for target in dof_sizes(min_dofs, max_dofs, per_decade):
+        size = 0.75/target
+        make = lambda: fem.make_mesh(0, [], 0, size)
+        V, E = make()
+        rec = bench_mesh(V, E, repeat, memory, solver, make)[0]
+        rec['series'] = 'uniform'
+        records.append(rec)
+        if verbose:
+            print('uniform d.o.f=', rec['dofs'],
+                  'FEM_sol %.3gs' % rec['t_FEM_sol'])
+    return records
+
+def amr_sweep(max_dofs=1e5, theta=0.5, repeat=1, memory=True, solver=None,
+              max_cycles=100, verbose=False):
+    """
+    Benchmark the meshes of an adaptive run started from the default
+    make_mesh mesh, refined by Doerfler marking until max_dofs. The
+    marking uses the solution and indicators of the benchmarked phases.
+    verbose prints a line per mesh.
+    """
+    V, E = fem.make_mesh(0, [], 0)
+    mesh = AdaptiveMesh(V, E)
+    records = []
+    for cycle in range(max_cycles):
+        rec, _, eta_K = bench_mesh(mesh.V, mesh.E, repeat, memory, solver)
+        rec['series'] = 'amr'
+        rec['cycle'] = cycle
+        records.append(rec)
+        if verbose:
+            print('amr d.o.f=', rec['dofs'],
+                  'FEM_sol %.3gs' % rec['t_FEM_sol'])
+        if rec['dofs'] >= max_dofs:
+            break
+        mesh.refine(fem.mark_elements(eta_K, 'doerfler', theta))
+    return records
+
+def scaling_exponents(records, min_dofs=1e3):
+    """
+    Least squares slope of log(t) over log(DOFs) for every phase, using
+    the records with at least min_dofs DOFs (small meshes are dominated
+    by fixed overheads). 1 is linear scaling.
+    """
+    recs = [r for r in records if r['dofs'] >= min_dofs]
+    out = {}
+    for name in PHASES:
+        pts = [(r['dofs'], r['t_'+name]) for r in recs
+               if r.get('t_'+name, 0) > 0]
+        if len(pts) >= 2:
+            x, y = np.log(np.array(pts)).T
+            out[name] = float(np.polyfit(x, y, 1)[0])
+    return out
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__,
+            'scipy': scipy.__version__, 'machine': platform.machine(),
+            'system': platform.system(), 'cpus': os.cpu_count(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def run(min_dofs=1e2, max_dofs=1e5, amr_max_dofs=None, per_decade=2,
+        repeat=1, memory=True, amr=True, solver=None, out=None, theta=0.5,
+        verbose=False):
+    """Run both sweeps and return (and optionally write) the results."""
+    if solver is None:
+        solver = LinearSolver('direct')
+    results = {'environment': environment(),
+               'solver': {'method': solver.method, 'precond': solver.precond},
+               'repeat': repeat, 'series': {}, 'scaling': {}}
+    series = {'uniform': uniform_sweep(min_dofs, max_dofs, per_decade, repeat,
+                                       memory, solver, verbose)}
+    if amr:
+        series['amr'] = amr_sweep(amr_max_dofs or max_dofs, theta, repeat,
+                                  memory, solver, verbose=verbose)
+    for name, records in series.items():
+        results['series'][name] = records
+        results['scaling'][name] = scaling_exponents(records)
+    if out is not None:
+        with open(out, 'w') as fh:
+            json.dump(results, fh, indent=1)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--min-dofs', type=float, default=1e2)
+    parser.add_argument('--max-dofs', type=float, default=1e5)
+    parser.add_argument('--amr-max-dofs', type=float, default=None,
+                        help='stop of the adaptive run (default --max-dofs)')
+    parser.add_argument('--theta', type=float, default=0.5,
+                        help='Doerfler fraction of the adaptive run')
+    parser.add_argument('--per-decade', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--solver', default='direct',
+                        choices=('direct', 'cholesky', 'cg'))
+    parser.add_argument('--precond', default='amg')
+    parser.add_argument('--no-amr', action='store_true')
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--out', default='bench.json')
+    args = parser.parse_args()
+
+    solver = LinearSolver(args.solver, args.precond, tol=1e-8)
+    results = run(args.min_dofs, args.max_dofs, args.amr_max_dofs,
+                  args.per_decade, args.repeat, not args.no_memory,
+                  not args.no_amr, solver, args.out, args.theta, verbose=True)
+    for name, exps in results['scaling'].items():
+        print(name, ' '.join('%s %.2f' % kv for kv in exps.items()))
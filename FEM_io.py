@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Binary checkpoints of meshes, solutions and refinement history
+
+A checkpoint is a single file:
+
+    magic    8 bytes   b'AFEMCKPT'
+    version  uint32    little-endian
+    hlen     uint32    length of the header in bytes
+    header   JSON      {'version', 'meta', 'arrays': {name: {'dtype',
+                        'shape', 'offset'}}}
+    data               raw little-endian C-ordered arrays, each starting
+                       at a multiple of 64 bytes from the data section,
+                       which itself starts at the first multiple of 64
+                       after the header
+
+so the arrays can be opened with np.memmap without copying or parsing.
+Stored arrays: V, E, dofs (the element DOF map), optionally U and
+eta_K, the AdaptiveMesh state (parent, level, vertex_parents and the
+refine() history flattened into hist_info/hist_marked/hist_changed)
+plus any extra named arrays.
+
+"""
+import json
+import os
+import struct
+
+import numpy as np
+
+from FEM_AMR_L_dom import element_dofs
+from FEM_mesh import AdaptiveMesh
+
+MAGIC = b'AFEMCKPT'
+VERSION = 1
+ALIGN = 64
+
+
+def _aligned(n):
+    return -(-n // ALIGN)*ALIGN
+
+def _history_arrays(history):
+    info = np.array([(h['nv'], h['ne'], len(h['marked']), len(h['changed']))
+                     for h in history], dtype=np.int64).reshape(-1, 4)
+    cat = lambda key: (np.concatenate([h[key] for h in history])
+                       if history else np.zeros(0, dtype=np.int64))
+    return {'hist_info': info, 'hist_marked': cat('marked'),
+            'hist_changed': cat('changed')}
+
+def save_checkpoint(path, V=None, E=None, U=None, eta_K=None, mesh=None,
+                    meta=None, **arrays):
+    """
+    Write a checkpoint of the mesh (V, E) or of the AdaptiveMesh mesh,
+    the displacement vector U and the error indicators eta_K (both
+    optional). meta is any JSON-serializable dict (e.g. the adapt()
+    cycle log), further keyword arrays are stored under their names.
+    The file is written next to path and moved in place, so an
+    interrupted write leaves the previous checkpoint intact.
+    """
+    if mesh is not None:
+        V, E = mesh.V, mesh.E
+    E = np.asarray(E)
+    data = {'V': V, 'E': E, 'dofs': element_dofs(E)}
+    if U is not None:
+        data['U'] = U
+    if eta_K is not None:
+        data['eta_K'] = eta_K
+    if mesh is not None:
+        data.update({'parent': mesh.parent, 'level': mesh.level,
+                     'vertex_parents': mesh.vertex_parents})
+        data.update(_history_arrays(mesh.history))
+    data.update(arrays)
+
+    table = {}
+    offset = 0
+    for name, arr in data.items():
+        arr = np.ascontiguousarray(arr)
+        data[name] = arr.astype(arr.dtype.newbyteorder('<'), copy=False)
+        table[name] = {'dtype': data[name].dtype.str, 'shape': arr.shape,
+                       'offset': offset}
+        offset = _aligned(offset + arr.nbytes)
+    header = json.dumps({'version': VERSION, 'meta': meta or {},
+                         'arrays': table}).encode('utf-8')
+    start = _aligned(16 + len(header))
+
+    path = os.fspath(path)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fh:
+        fh.write(MAGIC + struct.pack('<II', VERSION, len(header)) + header)
+        for name, arr in data.items():
+            fh.seek(start + table[name]['offset'])
+            fh.write(arr.tobytes())
+        fh.truncate(start + offset)
+    os.replace(tmp, path)
+
+
+class Checkpoint:
+    """
+    Arrays of a loaded checkpoint, indexed by name (ckpt['U']), and its
+    meta dict. With mmap the arrays are read-only views of the file.
+    """
+    def __init__(self, path, version, meta, arrays):
+        self.path = path
+        self.version = version
+        self.meta = meta
+        self.arrays = arrays
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def keys(self):
+        return self.arrays.keys()
+
+    def history(self):
+        """The refine() history as the list of dicts AdaptiveMesh keeps."""
+        if 'hist_info' not in self:
+            return []
+        out = []
+        im = ic = 0
+        for nv, ne, nm, nc in self['hist_info'].tolist():
+            out.append({'nv': nv, 'ne': ne,
+                        'marked': np.array(self['hist_marked'][im:im+nm]),
+                        'changed': np.array(self['hist_changed'][ic:ic+nc])})
+            im += nm
+            ic += nc
+        return out
+
+    def adaptive_mesh(self):
+        """
+        AdaptiveMesh in the saved state, ready for further refine()
+        calls. Checkpoints of a plain (V, E) start a new history.
+        """
+        if 'parent' not in self:
+            return AdaptiveMesh(self['V'], self['E'])
+        return AdaptiveMesh.from_state(self['V'], self['E'], self['parent'],
+                                       self['level'], self['vertex_parents'],
+                                       self.history())
+
+def load_checkpoint(path, mmap=True):
+    """Open a checkpoint written by save_checkpoint."""
+    with open(path, 'rb') as fh:
+        head = fh.read(16)
+        if len(head) < 16 or head[:8] != MAGIC:
+            raise ValueError('%s is not a FEM checkpoint' % path)
+        version, hlen = struct.unpack('<II', head[8:])
+        if version > VERSION:
+            raise ValueError('Checkpoint version %d is newer than the '
+                             'supported version %d' % (version, VERSION))
+        header = json.loads(fh.read(hlen).decode('utf-8'))
+    start = _aligned(16 + hlen)
+
+    arrays = {}
+    for name, info in header['arrays'].items():
+        dtype = np.dtype(info['dtype'])
+        shape = tuple(info['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        elif mmap:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r',
+                                     offset=start + info['offset'],
+                                     shape=shape)
+        else:
+            with open(path, 'rb') as fh:
+                fh.seek(start + info['offset'])
+                arrays[name] = np.fromfile(fh, dtype=dtype,
+                                           count=int(np.prod(shape))
+                                           ).reshape(shape)
+    return Checkpoint(path, version, header['meta'], arrays)
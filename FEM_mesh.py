@@ -0,0 +1,547 @@
+# -*- coding: utf-8 -*-
+"""
+Mesh utilities for the adaptive loop: point location in a triangulation,
+transfer of nodal fields between meshes, in-place local refinement and
+bandwidth reducing renumbering
+
+"""
+import numpy as np
+import scipy.sparse as sparse
+import scipy.sparse.csgraph as csgraph
+import scipy.sparse.linalg
+from scipy.spatial import cKDTree
+
+
+class MeshLocator:
+    """
+    Spatial queries on a fixed triangulation, built once per mesh.
+    KD-trees over the vertices and the element centroids answer nearest
+    vertex and point-in-triangle queries; the boundary edges are kept
+    for segment queries used to tag loads and boundary conditions.
+    Points closer than tol to a vertex or a segment count as on it.
+    E may also hold six-node triangles [v0, v1, v2, m01, m12, m20], the
+    midpoint nodes then take part in the queries.
+    """
+    def __init__(self, V, E, tol=1e-10):
+        self.V = V
+        self.E = E
+        self.tol = tol
+        self.vertex_tree = cKDTree(V)
+        self.centroid_tree = cKDTree(V[E].mean(axis=1))
+
+        x0 = V[E[:, 0]]
+        T = np.stack((V[E[:, 1]]-x0, V[E[:, 2]]-x0), axis=2)
+        detT = T[:, 0, 0]*T[:, 1, 1] - T[:, 0, 1]*T[:, 1, 0]
+        invT = np.empty_like(T)
+        invT[:, 0, 0] = T[:, 1, 1]
+        invT[:, 0, 1] = -T[:, 0, 1]
+        invT[:, 1, 0] = -T[:, 1, 0]
+        invT[:, 1, 1] = T[:, 0, 0]
+        self._x0 = x0
+        self._invT = invT/detT[:, None, None]
+
+        edges, el2edge, edge2el = mesh_edges(E[:, :3])
+        if E.shape[1] == 6:
+            mid = np.empty(len(edges), dtype=edges.dtype)
+            mid[el2edge] = E[:, 3:]
+            edges = np.column_stack((edges, mid))
+        self.boundary_edges = edges[edge2el[:, 1] < 0]
+
+    def nearest_vertex(self, P):
+        """Index of and distance to the nearest vertex of each point."""
+        dist, idx = self.vertex_tree.query(np.atleast_2d(P))
+        return idx, dist
+
+    def locate(self, P, k=8):
+        """
+        Triangle containing each point of P (np, 2). Candidates are the
+        k elements with the nearest centroids; on graded meshes the
+        containing element can be further away, so points not found
+        among them are searched again with four times as many, up to
+        all elements. Raises ValueError for points outside the mesh.
+        Returns the element indices (np,) and barycentric coordinates
+        (np, 3).
+        """
+        P = np.atleast_2d(P)
+        el = np.empty(len(P), dtype=np.int64)
+        lam = np.empty((len(P), 3))
+        todo = np.arange(len(P))
+        while len(todo):
+            k = min(k, len(self.E))
+            _, cand = self.centroid_tree.query(P[todo], k=k)
+            cand = cand.reshape(len(todo), k)
+
+            # barycentric coordinates of every point in all its candidates
+            l12 = np.einsum('pkij,pkj->pki', self._invT[cand],
+                            P[todo, None, :]-self._x0[cand])
+            lk = np.concatenate((1-l12.sum(axis=2, keepdims=True), l12),
+                                axis=2)
+            inside = lk.min(axis=2) >= -self.tol
+            best = np.argmax(inside, axis=1)
+            rows = np.flatnonzero(inside.any(axis=1))
+            el[todo[rows]] = cand[rows, best[rows]]
+            lam[todo[rows]] = lk[rows, best[rows]]
+            todo = np.delete(todo, rows)
+            if k == len(self.E):
+                break
+            k *= 4
+        if len(todo):
+            raise ValueError('%d point(s) outside the mesh, e.g. (%g, %g)'
+                             % ((len(todo),) + tuple(P[todo[0]])))
+        return el, lam
+
+    def point_load(self, x, y, load_dir, value=1.0):
+        """
+        Nodal forces equivalent to a point load at (x, y) in direction
+        load_dir (0: x, 1: y). A load on a node goes to that node,
+        otherwise it is distributed through the shape functions of the
+        containing element. Returns the DOFs and the nodal values.
+        """
+        idx, dist = self.nearest_vertex((x, y))
+        if dist[0] < self.tol:
+            return np.array([2*idx[0]+load_dir]), np.array([value])
+        el, lam = self.locate((x, y))
+        N = lam[0]
+        if self.E.shape[1] == 6:
+            N = np.concatenate((N*(2*N-1), 4*N*np.roll(N, -1)))
+        return 2*self.E[el[0]]+load_dir, value*N
+
+    def _on_segment(self, P, p0, p1):
+        p0, p1 = np.asarray(p0, float), np.asarray(p1, float)
+        d = p1-p0
+        L2 = d @ d
+        rel = P-p0
+        s = (rel @ d)/L2
+        dist = np.abs(rel[..., 0]*d[1] - rel[..., 1]*d[0])/np.sqrt(L2)
+        eps = self.tol/np.sqrt(L2)
+        return (dist < self.tol) & (s > -eps) & (s < 1+eps)
+
+    def boundary_edges_on(self, p0, p1):
+        """
+        Boundary edges (n, 2) with both end points on the segment, with
+        the midpoint node as third column on six-node elements.
+        """
+        on = self._on_segment(self.V[self.boundary_edges], p0, p1)
+        return self.boundary_edges[on.all(axis=1)]
+
+    def boundary_vertices_on(self, p0, p1):
+        """Mask (nv,) of the boundary vertices on the segment p0-p1."""
+        mask = np.zeros(len(self.V), dtype=bool)
+        mask[self.boundary_edges_on(p0, p1).ravel()] = True
+        return mask
+
+def locate_points(V, E, P, k=8, tol=1e-10):
+    """
+    Find the triangle of (V, E) containing each point of P (np, 2),
+    see MeshLocator.locate.
+    """
+    return MeshLocator(V, E, tol).locate(P, k)
+
+def transfer_matrix(V_old, E_old, V_new):
+    """
+    Barycentric interpolation operator (nv_new, nv_old) from the P1
+    space on (V_old, E_old) to the vertices V_new.
+    """
+    el, lam = locate_points(V_old, E_old, V_new)
+    rows = np.repeat(np.arange(len(V_new)), 3)
+    return sparse.csr_matrix((lam.ravel(), (rows, E_old[el].ravel())),
+                             shape=(len(V_new), len(V_old)))
+
+def transfer_solution(V_old, E_old, U_old, V_new):
+    """
+    Interpolate the displacement vector U_old (2*nv_old,) onto the
+    vertices V_new, e.g. to warm start the solve on a refined mesh.
+    """
+    P = transfer_matrix(V_old, E_old, V_new)
+    return (P @ U_old.reshape(-1, 2)).ravel()
+
+def mesh_edges(E):
+    """
+    Edge-to-element adjacency of a triangulation. Local edge j of an
+    element joins its vertices j and (j+1)%3.
+    Returns
+        edges   (ned, 2) vertex pairs, sorted within the pair
+        el2edge (ne, 3)  global edge of each local edge
+        edge2el (ned, 2) the two elements sharing an edge, -1 as the
+                         second entry for boundary edges
+    """
+    ne = len(E)
+    loc = np.stack((E, np.roll(E, -1, axis=1)), axis=2).reshape(-1, 2)
+    loc = np.sort(loc, axis=1)
+    edges, inv = np.unique(loc, axis=0, return_inverse=True)
+    inv = inv.ravel()
+    el = np.repeat(np.arange(ne), 3)
+
+    edge2el = np.full((len(edges), 2), -1, dtype=np.int64)
+    edge2el[inv[::-1], 0] = el[::-1]
+    edge2el[inv, 1] = el
+    edge2el[edge2el[:, 1] == edge2el[:, 0], 1] = -1
+    return edges, inv.reshape(ne, 3), edge2el
+
+
+class AdaptiveMesh:
+    """
+    Triangulation refined in place by newest vertex bisection.
+
+    Every element (a, b, c) is stored with its newest vertex a first, so
+    its refinement edge is (b, c). Bisection puts the midpoint m on (b, c)
+    and replaces the element by (m, a, b), kept at the same index, and
+    (m, c, a), appended at the end. Conformity is restored by closure:
+    any element with a bisected edge also has its refinement edge
+    bisected. Unrefined elements keep their index and vertices, so the
+    cost of refine() is proportional to the refined region only.
+
+    V and E are views of the internal buffers and change in place on
+    refine(); copy them to keep an older mesh around. The refinement
+    history is kept in parent/level (per element), vertex_parents (the
+    edge each new vertex bisects) and history (one record per refine).
+    """
+    def __init__(self, V, E):
+        V = np.array(V, dtype=float)
+        E = np.array(E, dtype=np.int64)
+
+        # counter-clockwise elements with the longest edge as refinement edge
+        x0, x1, x2 = V[E[:, 0]], V[E[:, 1]], V[E[:, 2]]
+        cw = ((x1-x0)[:, 0]*(x2-x0)[:, 1] - (x1-x0)[:, 1]*(x2-x0)[:, 0]) < 0
+        E[cw] = E[cw][:, ::-1]
+        opp = np.stack([np.sum((V[np.roll(E, -j, axis=1)[:, 1]] -
+                                V[np.roll(E, -j, axis=1)[:, 2]])**2, axis=1)
+                        for j in range(3)], axis=1)
+        shift = np.argmax(opp, axis=1)
+        E = E[np.arange(len(E))[:, None], (np.arange(3) + shift[:, None]) % 3]
+        self._init_state(V, E)
+
+    def _init_state(self, V, E):
+        self.nv, self.ne = len(V), len(E)
+        self._V = V
+        self._E = E
+        self._parent = np.arange(self.ne)
+        self._level = np.zeros(self.ne, dtype=np.int64)
+        self._vertex_parents = np.full((self.nv, 2), -1, dtype=np.int64)
+        self.history = []
+
+        edges, _, edge2el = mesh_edges(E)
+        self._edge_elems = {(a, b): [t for t in pair if t >= 0]
+                            for (a, b), pair in zip(edges.tolist(),
+                                                    edge2el.tolist())}
+
+    @classmethod
+    def from_state(cls, V, E, parent=None, level=None, vertex_parents=None,
+                   history=()):
+        """
+        Rebuild a mesh saved part way through the refinement, e.g. by
+        FEM_io. The elements are taken as they are, they already hold
+        their newest vertex first. The arrays are copied.
+        """
+        mesh = cls.__new__(cls)
+        mesh._init_state(np.array(V, dtype=float), np.array(E, dtype=np.int64))
+        if parent is not None:
+            mesh._parent = np.array(parent, dtype=np.int64)
+        if level is not None:
+            mesh._level = np.array(level, dtype=np.int64)
+        if vertex_parents is not None:
+            mesh._vertex_parents = np.array(vertex_parents, dtype=np.int64)
+        mesh.history = list(history)
+        return mesh
+
+    @property
+    def V(self):
+        return self._V[:self.nv]
+
+    @property
+    def E(self):
+        return self._E[:self.ne]
+
+    @property
+    def parent(self):
+        """
+        Element of the previous mesh each element was cut from in the
+        last refine(), its own index for elements it left untouched.
+        """
+        return self._parent[:self.ne]
+
+    @property
+    def level(self):
+        """Number of bisections since the initial mesh."""
+        return self._level[:self.ne]
+
+    @property
+    def vertex_parents(self):
+        """Endpoints of the edge each vertex bisects, -1 for initial ones."""
+        return self._vertex_parents[:self.nv]
+
+    def _reserve(self, nv, ne):
+        if nv > len(self._V):
+            size = max(nv, 2*len(self._V))
+            self._V = np.resize(self._V, (size, 2))
+            self._vertex_parents = np.resize(self._vertex_parents, (size, 2))
+        if ne > len(self._E):
+            size = max(ne, 2*len(self._E))
+            self._E = np.resize(self._E, (size, 3))
+            self._parent = np.resize(self._parent, size)
+            self._level = np.resize(self._level, size)
+
+    def _ref_edge(self, t):
+        _, b, c = self._E[t].tolist()
+        return (b, c) if b < c else (c, b)
+
+    def _swap_elem(self, edge, old, new):
+        elems = self._edge_elems.setdefault(edge, [])
+        if old in elems:
+            elems.remove(old)
+        if new is not None:
+            elems.append(new)
+        if not elems:
+            del self._edge_elems[edge]
+
+    def _bisect(self, t, marked, midpoint, changed):
+        a, b, c = self._E[t].tolist()
+        bc = (b, c) if b < c else (c, b)
+        m = midpoint.get(bc)
+        if m is None:
+            m = midpoint[bc] = self.nv
+            self._V[m] = 0.5*(self._V[b] + self._V[c])
+            self._vertex_parents[m] = bc
+            self.nv += 1
+        s = self.ne
+        self.ne += 1
+        self._E[t] = (m, a, b)
+        self._E[s] = (m, c, a)
+        self._parent[s] = self._parent[t]
+        self._level[t] += 1
+        self._level[s] = self._level[t]
+        changed.append(s)
+
+        ca = (c, a) if c < a else (a, c)
+        ab = (a, b) if a < b else (b, a)
+        self._swap_elem(bc, t, None)
+        self._swap_elem(ca, t, s)
+        self._swap_elem((m, a) if m < a else (a, m), None, t)
+        self._swap_elem((m, a) if m < a else (a, m), None, s)
+        self._swap_elem((b, m) if b < m else (m, b), None, t)
+        self._swap_elem((c, m) if c < m else (m, c), None, s)
+
+        # the two other edges become the children's refinement edges
+        if ab in marked:
+            self._bisect(t, marked, midpoint, changed)
+        if ca in marked:
+            self._bisect(s, marked, midpoint, changed)
+
+    def refine(self, marked):
+        """
+        Bisect the marked elements plus the closure needed to keep the
+        mesh conforming. Returns the indices of all changed or new
+        elements.
+        """
+        marked = np.unique(np.asarray(marked, dtype=np.int64))
+        nv_old, ne_old = self.nv, self.ne
+
+        # refinement edges of the marked elements and their closure
+        edges = set()
+        stack = []
+        for t in marked.tolist():
+            e = self._ref_edge(t)
+            if e not in edges:
+                edges.add(e)
+                stack.append(e)
+        while stack:
+            for t in self._edge_elems.get(stack.pop(), ()):
+                e = self._ref_edge(t)
+                if e not in edges:
+                    edges.add(e)
+                    stack.append(e)
+
+        to_bisect = sorted({t for e in edges for t in self._edge_elems[e]})
+        self._reserve(self.nv + len(edges), self.ne + 3*len(to_bisect))
+        self._parent[:ne_old] = np.arange(ne_old)
+        changed = list(to_bisect)
+        midpoint = {}
+        for t in to_bisect:
+            self._bisect(t, edges, midpoint, changed)
+
+        changed = np.array(sorted(changed), dtype=np.int64)
+        self.history.append({'marked': marked, 'changed': changed,
+                             'nv': nv_old, 'ne': ne_old})
+        return changed
+
+    def prolongate(self, U, nv_old=None):
+        """
+        Interpolate a nodal field (e.g. the displacement vector) from the
+        mesh before the last refine() onto the current vertices. On the
+        nested meshes this is exact for the P1 space: each new vertex
+        takes the mean of the endpoints of the edge it bisects.
+        """
+        if nv_old is None:
+            nv_old = self.history[-1]['nv']
+        Uv = np.asarray(U).reshape(nv_old, -1)
+        out = np.empty((self.nv, Uv.shape[1]))
+        out[:nv_old] = Uv
+        new = np.arange(nv_old, self.nv)
+        done = np.zeros(self.nv, dtype=bool)
+        done[:nv_old] = True
+        while len(new):
+            pa = self._vertex_parents[new]
+            ready = done[pa].all(axis=1)
+            out[new[ready]] = 0.5*(out[pa[ready, 0]] + out[pa[ready, 1]])
+            done[new[ready]] = True
+            new = new[~ready]
+        return out if np.ndim(U) > 1 else out.ravel()
+
+    def prolongation(self, nv_coarse, nv_fine=None):
+        """
+        P1 interpolation matrix (nv_fine, nv_coarse) between two meshes
+        of the refinement history, given by their vertex counts (default
+        fine mesh: the current one). Vertices are never renumbered, so it
+        is the identity on the coarse vertices, and every newer vertex is
+        the mean of the endpoints of the edge it bisects.
+        """
+        if nv_fine is None:
+            nv_fine = self.nv
+        new = np.arange(nv_coarse, nv_fine)
+        pa = self._vertex_parents[new]
+        # a new vertex may bisect an edge of vertices new themselves;
+        # A is strictly lower triangular, P = sum_k A^k [I; 0]
+        A = sparse.csr_matrix((np.full(2*len(new), 0.5),
+                               (np.repeat(new, 2), pa.ravel())),
+                              shape=(nv_fine, nv_fine))
+        T = sparse.eye(nv_fine, nv_coarse, format='csr')
+        P = T
+        while T.nnz:
+            T = A @ T
+            P = P + T
+        return P.tocsr()
+
+
+def vertex_graph(E, nv=None):
+    """
+    Symmetric vertex adjacency matrix (CSR, no diagonal) of a mesh: the
+    nodes sharing an element, so six-node elements work as well.
+    """
+    if nv is None:
+        nv = int(E.max())+1
+    k = E.shape[1]
+    i = np.repeat(E, k, axis=1).ravel()
+    j = np.tile(E, (1, k)).ravel()
+    off = i != j
+    A = sparse.csr_matrix((np.ones(off.sum()), (i[off], j[off])),
+                          shape=(nv, nv))
+    A.data[:] = 1.0
+    return A
+
+def _nested_dissection(V, A, leaf=64):
+    # geometric nested dissection: split at the median of the longest
+    # extent, the vertices of one half touching the other half form the
+    # separator and are numbered after both halves
+    order = []
+    def dissect(idx):
+        pts = V[idx]
+        ext = np.ptp(pts, axis=0)
+        if len(idx) <= leaf or ext.max() == 0:
+            order.append(idx)
+            return
+        axis = np.argmax(ext)
+        left = pts[:, axis] <= np.median(pts[:, axis])
+        if left.all():
+            order.append(idx)
+            return
+        L, R = idx[left], idx[~left]
+        in_R = np.zeros(A.shape[0])
+        in_R[R] = 1.0
+        sep = (A[L] @ in_R) > 0
+        dissect(L[~sep])
+        dissect(R)
+        order.append(L[sep])
+    dissect(np.arange(A.shape[0]))
+    return np.concatenate(order)
+
+def ordering_stats(E, nv=None, fill=False, permc_spec='COLAMD'):
+    """
+    Bandwidth and profile of the vertex graph of E in its current
+    numbering (the DOF bandwidth is 2*bandwidth+1). With fill=True also
+    the fill ratio nnz(L+U)/nnz(A) of the SuperLU factorization with the
+    column ordering permc_spec, computed on an SPD matrix with the
+    graph's pattern. The default is the COLAMD ordering LinearSolver
+    ('direct') uses, which largely ignores the vertex numbering; the
+    numbering only matters to the fill with permc_spec='NATURAL'.
+    """
+    A = vertex_graph(E, nv)
+    coo = A.tocoo()
+    first = np.arange(A.shape[0])
+    np.minimum.at(first, coo.row, coo.col)
+    stats = {'bandwidth': int(np.abs(coo.row - coo.col).max()),
+             'profile': int(np.sum(np.arange(A.shape[0]) - first))}
+    if fill:
+        deg = np.asarray(A.sum(axis=1)).ravel()
+        M = sparse.diags(deg+1.0) - A
+        lu = sparse.linalg.splu(M.tocsc(), permc_spec=permc_spec)
+        stats['fill'] = (lu.L.nnz + lu.U.nnz - M.shape[0])/M.nnz
+    return stats
+
+
+class Renumbering:
+    """
+    Vertex and element permutation of a renumbered mesh.
+    vperm[new] = old vertex, eperm[new] = old element. restore() and
+    restore_elements() map results on the renumbered mesh back to the
+    original numbering. stats holds bandwidth/fill before and after.
+    """
+    def __init__(self, vperm, eperm):
+        self.vperm = vperm
+        self.eperm = eperm
+        self.vinv = np.empty_like(vperm)
+        self.vinv[vperm] = np.arange(len(vperm))
+        self.stats = {}
+
+    def apply(self, V, E):
+        return V[self.vperm], self.vinv[E[self.eperm]]
+
+    def restore(self, U):
+        """Nodal vector (2*nv,) or array (nv, k) back to the old numbering."""
+        Uv = np.asarray(U).reshape(len(self.vperm), -1)
+        out = np.empty_like(Uv)
+        out[self.vperm] = Uv
+        return out.reshape(np.shape(U))
+
+    def restore_elements(self, a):
+        """Element array (ne, ...) back to the old element numbering."""
+        out = np.empty_like(a)
+        out[self.eperm] = a
+        return out
+
+def vertex_ordering(V, E, method='rcm'):
+    """
+    Vertex permutation vperm[new] = old of the mesh: 'rcm' (reverse
+    Cuthill-McKee) or 'nd' (geometric nested dissection).
+    """
+    A = vertex_graph(E, len(V))
+    if method == 'rcm':
+        vperm = csgraph.reverse_cuthill_mckee(A, symmetric_mode=True)
+    elif method == 'nd':
+        vperm = _nested_dissection(V, A)
+    else:
+        raise ValueError('Unknown ordering: %s' % method)
+    return np.asarray(vperm, dtype=np.int64)
+
+def renumber_mesh(V, E, method='rcm', fill=False, permc_spec='COLAMD'):
+    """
+    Renumber the vertices of (V, E) to reduce the bandwidth of the
+    stiffness matrix, see vertex_ordering. Elements are then sorted by
+    their lowest vertex so element loops sweep the DOFs in order.
+    Returns the renumbered V, E and the Renumbering, whose stats compare
+    the orderings (the fill for the SuperLU ordering permc_spec, see
+    ordering_stats).
+    """
+    vperm = vertex_ordering(V, E, method)
+    vinv = np.empty_like(vperm)
+    vinv[vperm] = np.arange(len(vperm))
+    eperm = np.argsort(vinv[E].min(axis=1), kind='stable')
+
+    ren = Renumbering(vperm, eperm)
+    V_new, E_new = ren.apply(V, E)
+    before = ordering_stats(E, len(V), fill, permc_spec)
+    after = ordering_stats(E_new, len(V), fill, permc_spec)
+    ren.stats = {'method': method}
+    for key in before:
+        ren.stats[key+'_before'] = before[key]
+        ren.stats[key+'_after'] = after[key]
+    return V_new, E_new, ren
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Partitioned element kernels on a process or thread pool
+
+The element range is split into contiguous chunks that the workers
+evaluate independently. In process mode the mesh, the displacement
+vector and the outputs live in shared memory blocks, so a task only
+carries the block names and its element range. Every chunk writes its
+own slice of the output and the global reduction (the bincount in
+MatrixBuilder / body_force) runs afterwards in element order, so the
+result does not depend on the number of workers or on scheduling.
+
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import FEM_AMR_L_dom as fem
+
+
+def _attach(spec):
+    name, shape, dtype = spec
+    # the workers share the parent's resource tracker, which already
+    # owns the block; the parent unlinks it once the tasks are done
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _run_chunk(kind, specs, lo, hi, params):
+    handles = {}
+    arrays = {}
+    for key, spec in specs.items():
+        if isinstance(spec, tuple):
+            handles[key], arrays[key] = _attach(spec)
+        else:
+            arrays[key] = spec
+    try:
+        _kernel(kind, arrays, lo, hi, params)
+    finally:
+        arrays.clear()
+        for shm in handles.values():
+            shm.close()
+
+def _kernel(kind, a, lo, hi, params):
+    V, E = a['V'], a['E'][lo:hi]
+    if kind == 'stiffness':
+        a['out'][lo:hi] = fem.element_stiffness(V, E, params['C'])
+    elif kind == 'body_force':
+        a['out'][lo:hi] = fem.element_body_force(V, E, params['rho'],
+                                                 params['g'])
+    elif kind == 'stress':
+        B, _ = fem.element_B(V, E)
+        eps = np.einsum('eij,ej->ei', B, a['U'][fem.element_dofs(E)])
+        a['out'][lo:hi] = eps @ params['C'].T
+    else:
+        raise ValueError('Unknown element kernel: %s' % kind)
+
+
+class ElementPool:
+    """
+    Worker pool for the element kernels of assembly and estimation.
+
+    executor:    'process' (shared memory buffers) or 'thread'
+    workers:     pool size, defaults to the number of cores
+    chunk_size:  elements per task, defaults to ne/(4*workers)
+    serial_below: meshes with fewer elements run in the calling process
+
+    Pass it as pool= to FEM_sol, FEM_Ktan_Fint, body_force and
+    error_estimator. Call close() (or use it as a context manager) to
+    shut the workers down.
+    """
+    def __init__(self, workers=None, executor='process', chunk_size=None,
+                 serial_below=20000):
+        if executor not in ('process', 'thread'):
+            raise ValueError('Unknown executor: %s' % executor)
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = executor
+        self.chunk_size = chunk_size
+        self.serial_below = serial_below
+        if executor == 'process':
+            self._pool = ProcessPoolExecutor(self.workers)
+        else:
+            self._pool = ThreadPoolExecutor(self.workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._pool.shutdown()
+
+    def _chunks(self, ne):
+        size = self.chunk_size or max(1, -(-ne // (4*self.workers)))
+        return [(lo, min(lo+size, ne)) for lo in range(0, ne, size)]
+
+    def _map(self, kind, arrays, out_shape, params):
+        ne = len(arrays['E'])
+        out = np.empty(out_shape)
+        if ne < self.serial_below:
+            _kernel(kind, dict(arrays, out=out), 0, ne, params)
+            return out
+        if self.executor == 'thread':
+            args = dict(arrays, out=out)
+            futures = [self._pool.submit(_kernel, kind, args, lo, hi, params)
+                       for lo, hi in self._chunks(ne)]
+            for fut in futures:
+                fut.result()
+            return out
+
+        blocks = []
+        try:
+            specs = {}
+            for key, arr in dict(arrays, out=out).items():
+                arr = np.ascontiguousarray(arr)
+                shm = shared_memory.SharedMemory(create=True,
+                                                 size=max(arr.nbytes, 1))
+                blocks.append(shm)
+                if key != 'out':
+                    np.ndarray(arr.shape, arr.dtype, buffer=shm.buf)[...] = arr
+                specs[key] = (shm.name, arr.shape, arr.dtype.str)
+            futures = [self._pool.submit(_run_chunk, kind, specs, lo, hi,
+                                         params)
+                       for lo, hi in self._chunks(ne)]
+            for fut in futures:
+                fut.result()
+            out[...] = np.ndarray(out.shape, out.dtype, buffer=blocks[-1].buf)
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+        return out
+
+    def stiffness(self, V, E, C):
+        """Element stiffness matrices (ne, nd, nd), nd = 2*E.shape[1]."""
+        nd = 2*E.shape[1]
+        return self._map('stiffness', {'V': V, 'E': E}, (len(E), nd, nd),
+                         {'C': C})
+
+    def body_force(self, V, E, rho=0.1, g=10):
+        """Element gravity loads (ne, nd)."""
+        return self._map('body_force', {'V': V, 'E': E},
+                         (len(E), 2*E.shape[1]), {'rho': rho, 'g': g})
+
+    def stresses(self, V, E, U, C):
+        """Stresses (ne, 3) of the linear elements for the displacements U."""
+        return self._map('stress', {'V': V, 'E': E, 'U': U}, (len(E), 3),
+                         {'C': C})
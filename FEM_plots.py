@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Plotting and figure saving for the L-domain FEA
+
+Kept out of FEM_AMR_L_dom so that the solver imports without the
+matplotlib stack; import this module only where figures are wanted.
+
+"""
+from mpl_toolkits.mplot3d import Axes3D  # registers the 3d projection
+import matplotlib.pyplot as plt
+
+
+def plot_mesh(V, E, U=None, title='', fname=None, num=None):
+    """
+    Plot the mesh (V, E) and, when U is given, the mesh deformed by the
+    displacement vector U on top of it. fname (optional) saves the
+    figure. Returns the figure.
+    """
+    fig = plt.figure(num, figsize=(7, 7))
+    plt.gca().set_aspect("equal")
+    X, Y = V[:, 0], V[:, 1]
+    plt.triplot(X, Y, E)
+    if U is not None:
+        U_mat = U[:2*len(V)].reshape((len(V), 2))
+        plt.triplot(X + U_mat[:, 0], Y + U_mat[:, 1], E)
+    plt.title(title, y=1.05, fontsize=10)
+    plt.xlabel('x')
+    plt.ylabel('y')
+    if fname is not None:
+        plt.savefig(fname)
+    return fig
+
+def plot_field(V, E, values, title='', fname=None, num=None):
+    """
+    Surface plot of the nodal field values over the mesh (V, E), e.g.
+    the internal force distribution. Returns the figure.
+    """
+    fig = plt.figure(num, figsize=(8, 8))
+    ax = fig.add_subplot(projection='3d')
+    ax.plot_trisurf(V[:, 0], V[:, 1], values, triangles=E, cmap=plt.cm.jet,
+                    linewidth=0.2)
+    plt.title(title, y=1.05, fontsize=10)
+    plt.xlabel('x')
+    plt.ylabel('y')
+    if fname is not None:
+        plt.savefig(fname)
+    return fig
+
+def close_all():
+    plt.close('all')
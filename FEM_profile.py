@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in phase profiler for the solve -> estimate -> mark -> refine cycle
+
+The solver code is instrumented with phase() blocks and count() calls
+that cost next to nothing while the profiler is disabled (the default).
+
+    import FEM_profile
+    FEM_profile.enable(memory=True)
+    mesh, U, log = adapt(V, E)
+    print(FEM_profile.report())
+
+Phases nest, a phase is recorded under the path of the enclosing ones,
+e.g. 'adapt/solve/assembly/element_kernels'. Callbacks registered with
+add_callback(fn) are called as fn(kind, name, value) for every finished
+phase (kind 'phase', value in seconds) and counter update (kind
+'counter'), e.g. to forward the metrics to a monitoring system.
+
+"""
+import functools
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class Profiler:
+    """
+    Wall clock (and optionally peak memory) per phase plus counters.
+
+    phases:   {path: {'calls', 'time', 'peak_mb'}}
+    counters: {name: value}, summed by count() or overwritten by gauge()
+    """
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.callbacks = []
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.counters = {}
+        self._stack = []
+
+    def enable(self, memory=False):
+        self.enabled = True
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        self.enabled = False
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.memory = False
+
+    def add_callback(self, fn):
+        self.callbacks.append(fn)
+
+    def remove_callback(self, fn):
+        self.callbacks.remove(fn)
+
+    def _emit(self, kind, name, value):
+        for fn in self.callbacks:
+            fn(kind, name, value)
+
+    @contextmanager
+    def phase(self, name):
+        # a phase re-entered from inside itself (e.g. one lazy geometry
+        # field computing another) is folded into the outer call
+        if not self.enabled or (self._stack and
+                                self._stack[-1]['name'] == name):
+            yield
+            return
+        path = '/'.join([f['path'] for f in self._stack[-1:]] + [name])
+        frame = {'name': name, 'path': path, 'peak': 0}
+        # created on entry, so that the report lists parents first
+        rec = self.phases.setdefault(path, {'calls': 0, 'time': 0.0,
+                                            'peak_mb': 0.0})
+        if self.memory:
+            # keep the outer phase's peak before restarting the count
+            cur, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            frame['start'] = cur
+            tracemalloc.reset_peak()
+        self._stack.append(frame)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter()-t0
+            self._stack.pop()
+            rec['calls'] += 1
+            rec['time'] += dt
+            if self.memory:
+                peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                rec['peak_mb'] = max(rec['peak_mb'],
+                                     (peak-frame['start'])/2**20)
+                if self._stack:
+                    self._stack[-1]['peak'] = max(self._stack[-1]['peak'],
+                                                  peak)
+            self._emit('phase', path, dt)
+
+    def profiled(self, name=None):
+        """Decorator running the function as a phase (default its name)."""
+        def wrap(fn):
+            label = name or fn.__name__
+            @functools.wraps(fn)
+            def inner(*args, **kwargs):
+                with self.phase(label):
+                    return fn(*args, **kwargs)
+            return inner
+        return wrap
+
+    def count(self, name, value=1):
+        """Add value to the counter name."""
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+            self._emit('counter', name, self.counters[name])
+
+    def gauge(self, name, value):
+        """Set the counter name to its latest value."""
+        if self.enabled:
+            self.counters[name] = value
+            self._emit('counter', name, value)
+
+    def summary(self):
+        return {'phases': {k: dict(v) for k, v in self.phases.items()},
+                'counters': dict(self.counters)}
+
+    def report(self):
+        """Phase table in call order, nested phases indented."""
+        lines = ['%-48s %7s %10s %10s' % ('phase', 'calls', 'time(s)',
+                                          'peak(MB)')]
+        for path, rec in self.phases.items():
+            depth = path.count('/')
+            label = '  '*depth + path.rsplit('/', 1)[-1]
+            lines.append('%-48s %7d %10.4f %10.2f' % (label, rec['calls'],
+                                                      rec['time'],
+                                                      rec['peak_mb']))
+        for name, value in self.counters.items():
+            lines.append('%-48s %s' % (name, value))
+        return '\n'.join(lines)
+
+
+# Module level profiler used by the instrumented code
+PROFILER = Profiler()
+
+def phase(name):
+    return PROFILER.phase(name)
+
+def profiled(name=None):
+    return PROFILER.profiled(name)
+
+def count(name, value=1):
+    PROFILER.count(name, value)
+
+def gauge(name, value):
+    PROFILER.gauge(name, value)
+
+def enable(memory=False):
+    PROFILER.enable(memory)
+
+def disable():
+    PROFILER.disable()
+
+def reset():
+    PROFILER.reset()
+
+def add_callback(fn):
+    PROFILER.add_callback(fn)
+
+def report():
+    return PROFILER.report()
+
+def summary():
+    return PROFILER.summary()
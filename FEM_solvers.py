@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+"""
+Linear solver backends for the reduced stiffness system K u = F
+
+The reduced stiffness matrix is symmetric positive definite, so besides
+the direct SuperLU factorization it can be solved with a sparse Cholesky
+factorization or with preconditioned conjugate gradients.
+
+"""
+import inspect
+import time
+
+import numpy as np
+import scipy.sparse as sparse
+import scipy.sparse.linalg as sla
+
+from FEM_profile import count, gauge, phase
+
+# scipy renamed the relative tolerance of cg from tol to rtol
+_CG_TOL = 'rtol' if 'rtol' in inspect.signature(sla.cg).parameters else 'tol'
+
+
+def jacobi_preconditioner(A):
+    d = A.diagonal()
+    inv_d = 1.0/np.where(d != 0, d, 1.0)
+    return sla.LinearOperator(A.shape, matvec=lambda x: inv_d*x,
+                              matmat=lambda X: inv_d[:, None]*X)
+
+def ichol_preconditioner(A, drop_tol=1e-4, fill_factor=10):
+    """
+    Incomplete Cholesky type preconditioner M = Q L D L^T Q^T. SciPy has
+    no incomplete Cholesky, so L and D are taken from a threshold ILU in
+    symmetric mode (symmetric ordering Q, diagonal pivots). Only the
+    unit lower factor and the pivots are kept, which makes M symmetric,
+    and positive definite with |D|, as CG requires.
+    """
+    ilu = sla.spilu(A.tocsc(), drop_tol=drop_tol, fill_factor=fill_factor,
+                    permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0.0,
+                    options={'SymmetricMode': True})
+    # rows and columns of A take the same order q in the factors
+    q = np.argsort(ilu.perm_r)
+    L = sparse.csr_matrix(ilu.L)
+    LT = sparse.csr_matrix(L.T)
+    d = np.abs(ilu.U.diagonal())
+    def solve(b):
+        y = sla.spsolve_triangular(L, b[q], lower=True, unit_diagonal=True)
+        y = sla.spsolve_triangular(LT, y/d, lower=False, unit_diagonal=True)
+        x = np.empty_like(y)
+        x[q] = y
+        return x
+    return sla.LinearOperator(A.shape, matvec=solve)
+
+def amg_preconditioner(A, near_null=None, **kwargs):
+    """
+    Smoothed-aggregation AMG V-cycle (needs pyamg). near_null (optional)
+    are near null space vectors, e.g. the rigid body modes.
+    """
+    try:
+        import pyamg
+    except ImportError:
+        raise ImportError('The amg preconditioner needs pyamg installed')
+    ml = pyamg.smoothed_aggregation_solver(A.tocsr(), B=near_null, **kwargs)
+    return ml.aspreconditioner(cycle='V')
+
+
+
+class Multigrid:
+    """
+    Geometric multigrid for the SPD system A x = b on nested spaces.
+
+    prolongations: [P_0, P_1, ...] with P_l (n_l, n_(l+1)) interpolating
+                   level l+1 onto level l, level 0 being A's (e.g. from
+                   the AMR hierarchy, see multigrid_prolongations in
+                   FEM_AMR_L_dom). The coarse operators are the Galerkin
+                   products P^T A P, the coarsest level is factorized.
+    cycle:         'V' or 'W'; the W-cycle visits the coarser levels
+                   twice only on the w_depth finest levels and is a
+                   V-cycle below. Each of those levels must have at most
+                   half the unknowns of the one above, otherwise the
+                   visits double per level (on a hierarchy of one level
+                   per refinement step take multigrid_prolongations with
+                   ratio=4)
+    smoother:      'chebyshev' - Chebyshev polynomial in D^-1 A of degree
+                                 presmooth/postsmooth, aimed at the upper
+                                 part [rho/30, 1.1 rho] of its spectrum
+                   'jacobi'    - presmooth/postsmooth damped Jacobi
+                                 sweeps, omega by default 4/(3 rho)
+                   rho is the spectral radius of D^-1 A, from a few power
+                   iterations. Both only use matvecs and vector updates.
+    local:         smooth a level only where it differs from the next
+                   coarser one, which is what keeps the cycle cheap and
+                   robust on a deep hierarchy of locally refined meshes
+    With equal pre- and post-smoothing the cycle is a symmetric
+    operator, so aspreconditioner() can be used with CG.
+    """
+    def __init__(self, A, prolongations=(), cycle='V', smoother='chebyshev',
+                 presmooth=3, postsmooth=3, omega=None, local=True,
+                 w_depth=4):
+        if cycle not in ('V', 'W'):
+            raise ValueError('Unknown multigrid cycle: %s' % cycle)
+        if smoother not in ('chebyshev', 'jacobi'):
+            raise ValueError('Unknown multigrid smoother: %s' % smoother)
+        self.gamma = 1 if cycle == 'V' else 2
+        self.w_depth = w_depth if cycle == 'W' else 0
+        self.smoother = smoother
+        self.presmooth = presmooth
+        self.postsmooth = postsmooth
+        self.omega = omega
+        self.P = [sparse.csr_matrix(P) for P in prolongations]
+        for l, P in enumerate(self.P[:self.w_depth]):
+            if 2*P.shape[1] > P.shape[0]:
+                raise ValueError('W-cycle level %d coarsens %d to %d unknowns,'
+                                 ' it needs at least a factor 2'
+                                 % (l, P.shape[0], P.shape[1]))
+        self.A = [sparse.csr_matrix(A)]
+        for P in self.P:
+            self.A.append(sparse.csr_matrix(P.T @ self.A[-1] @ P))
+        self.smoothers = [self._setup_smoother(Al, P, local)
+                          for Al, P in zip(self.A[:-1], self.P)]
+        self.coarse = sla.splu(sparse.csc_matrix(self.A[-1]))
+
+    @staticmethod
+    def _setup_smoother(A, P, local):
+        # With local smoothing a level is only smoothed where it differs
+        # from the next coarser one: the DOFs that are not simply
+        # injected (the new vertices) and their neighbours. On a locally
+        # refined hierarchy this keeps every level cheap.
+        S = None
+        if local:
+            single = np.diff(P.indptr) == 1
+            injected = np.zeros(P.shape[0], dtype=bool)
+            injected[single] = P.data[P.indptr[:-1][single]] == 1
+            new = np.flatnonzero(~injected)
+            touched = np.zeros(A.shape[0], dtype=bool)
+            touched[A[new].indices] = True
+            touched[new] = True
+            if touched.sum() < 0.9*A.shape[0]:
+                S = np.flatnonzero(touched)
+        A_S = A if S is None else A[S]
+        A_SS = A if S is None else A_S[:, S]
+        d = A_SS.diagonal()
+        inv_d = 1.0/np.where(d != 0, d, 1.0)
+        rho = Multigrid._rho(A_SS, inv_d) if A_SS.shape[0] else 1.0
+        return S, A_S, A_SS, inv_d, rho
+
+    @staticmethod
+    def _rho(A, inv_d, its=20):
+        x = np.random.default_rng(0).random(A.shape[0])
+        rho = 1.0
+        for _ in range(its):
+            y = inv_d*(A @ x)
+            rho = np.linalg.norm(y)/np.linalg.norm(x)
+            x = y/np.linalg.norm(y)
+        return rho
+
+    def _smooth(self, l, b, x, nu):
+        S, A_S, A, inv_d, rho = self.smoothers[l]
+        if nu == 0 or A.shape[0] == 0:
+            return x
+        # smooth the correction e of A_SS e = r, r the residual on S
+        r = (b if S is None else b[S]) - A_S @ x
+        if self.smoother == 'jacobi':
+            w = self.omega if self.omega is not None else 4.0/(3.0*rho)
+            e = w*inv_d*r
+            for _ in range(nu-1):
+                e = e + w*inv_d*(r - A @ e)
+        else:
+            # three-term Chebyshev recurrence on [lmin, lmax]
+            lmax = 1.1*rho
+            lmin = lmax/30.0
+            theta = 0.5*(lmax + lmin)
+            delta = 0.5*(lmax - lmin)
+            sigma = theta/delta
+            z = inv_d*r
+            d = z/theta
+            e = np.zeros_like(r)
+            rho_k = 1.0/sigma
+            for k in range(nu):
+                e = e + d
+                if k == nu-1:
+                    break
+                z = z - inv_d*(A @ d)
+                rho_n = 1.0/(2.0*sigma - rho_k)
+                d = rho_n*rho_k*d + 2.0*rho_n/delta*z
+                rho_k = rho_n
+        if S is None:
+            return x + e
+        x = x.copy()
+        x[S] += e
+        return x
+
+    @property
+    def levels(self):
+        return [A.shape[0] for A in self.A]
+
+    def _cycle(self, l, b, x):
+        if l == len(self.P):
+            return self.coarse.solve(b)
+        A, P = self.A[l], self.P[l]
+        x = self._smooth(l, b, x, self.presmooth)
+        rc = P.T @ (b - A @ x)
+        ec = np.zeros_like(rc)
+        w = l < self.w_depth and l+1 < len(self.P)
+        for _ in range(self.gamma if w else 1):
+            ec = self._cycle(l+1, rc, ec)
+        x = x + P @ ec
+        return self._smooth(l, b, x, self.postsmooth)
+
+    def cycle(self, b, x=None):
+        """One multigrid cycle from the initial guess x (default 0)."""
+        count('mg_cycles')
+        b = np.asarray(b, dtype=float)
+        return self._cycle(0, b, np.zeros_like(b) if x is None else x)
+
+    def solve(self, b, x0=None, tol=1e-10, maxiter=None, atol=0.0):
+        """
+        Stand-alone cycling until ||b - A x|| <= max(tol ||b||, atol).
+        Returns x, the number of cycles and whether it converged.
+        """
+        x = np.zeros_like(b) if x0 is None else np.array(x0, dtype=float)
+        stop = max(tol*np.linalg.norm(b), atol)
+        maxiter = maxiter or 100
+        for its in range(maxiter+1):
+            if np.linalg.norm(b - self.A[0] @ x) <= stop:
+                return x, its, True
+            if its < maxiter:
+                x = self.cycle(b, x)
+        return x, maxiter, False
+
+    def aspreconditioner(self):
+        return sla.LinearOperator(self.A[0].shape, matvec=self.cycle)
+
+def multigrid_preconditioner(A, prolongations=(), **kwargs):
+    return Multigrid(A, prolongations, **kwargs).aspreconditioner()
+
+PRECONDITIONERS = {
+    None: lambda A, **kw: None,
+    'jacobi': lambda A, **kw: jacobi_preconditioner(A),
+    'ichol': ichol_preconditioner,
+    'amg': amg_preconditioner,
+    'gmg': multigrid_preconditioner,
+    }
+
+
+class LinearSolver:
+    """
+    Selectable solver for the SPD stiffness system.
+
+    method:  'direct'    - SuperLU factorization (scipy spsolve)
+             'cholesky'  - CHOLMOD via scikit-sparse, falls back to
+                           'direct' when it is not installed
+             'cg'        - preconditioned conjugate gradients
+             'multigrid' - geometric multigrid cycles (see Multigrid)
+    precond: None, 'jacobi', 'ichol', 'amg' or 'gmg' (only used by 'cg')
+
+    permc_spec is the SuperLU column ordering of 'direct' (default
+    COLAMD); 'NATURAL' keeps the DOF order, e.g. that of a mesh
+    renumbered with FEM_mesh.renumber_mesh or of FEM_sol(ordering=...).
+    The multigrid method and the 'gmg' preconditioner need the
+    prolongations of the mesh hierarchy, passed to setup() (or as a
+    keyword here when the hierarchy does not change); the other keywords
+    (cycle, presmooth, ...) go to Multigrid.
+
+    setup() factorizes the matrix or builds the preconditioner once;
+    solve() can then be called for any number of right hand sides.
+    setup(A, perm=...) solves the symmetrically permuted A[perm][:, perm]
+    instead (e.g. in an RCM order), while solve() still takes and
+    returns vectors in the order of A.
+    'cg' also takes a matrix-free operator (e.g. StiffnessOperator)
+    in place of the matrix, with the jacobi or no preconditioner.
+    The iterative methods stop at ||b - A x|| <= max(tol ||b||, atol),
+    and with rtol0 also once ||b - A x|| <= rtol0 ||b - A x0||, i.e.
+    relative to the residual of the initial guess. A warm start from a
+    coarser mesh has a small energy error but a large residual at the
+    new vertices, so only the rtol0 test lets it stop early.
+    Tolerances, iteration counts and timings are kept in self.stats.
+    """
+    def __init__(self, method='direct', precond='jacobi', tol=1e-10,
+                 maxiter=None, atol=0.0, rtol0=None, permc_spec=None,
+                 **precond_kwargs):
+        if method not in ('direct', 'cholesky', 'cg', 'multigrid'):
+            raise ValueError('Unknown solver method: %s' % method)
+        if precond not in PRECONDITIONERS:
+            raise ValueError('Unknown preconditioner: %s' % precond)
+        self.method = method
+        self.precond = precond
+        self.tol = tol
+        self.atol = atol
+        self.rtol0 = rtol0
+        self.maxiter = maxiter
+        self.permc_spec = permc_spec
+        self.precond_kwargs = precond_kwargs
+        self.A = None
+        self.perm = None
+        self._solve = None
+        self.stats = {}
+
+    def setup(self, A, perm=None, **precond_kwargs):
+        """
+        Factorize A or build its preconditioner. perm (optional) is the
+        order of the unknowns to solve in, see above. precond_kwargs
+        override the constructor's for this matrix, e.g. the
+        prolongations (with rows in the order of A).
+        """
+        t0 = time.perf_counter()
+        kwargs = dict(self.precond_kwargs, **precond_kwargs)
+        if not sparse.issparse(A) and (self.method != 'cg' or
+                                       self.precond not in (None, 'jacobi')):
+            raise ValueError('%s with preconditioner %s needs an assembled '
+                             'matrix' % (self.method, self.precond))
+        self.perm = perm
+        if perm is not None:
+            if not sparse.issparse(A):
+                raise ValueError('perm needs an assembled matrix')
+            A = sparse.csr_matrix(A)[perm][:, perm]
+            if kwargs.get('prolongations'):
+                P = list(kwargs['prolongations'])
+                P[0] = P[0][perm]
+                kwargs['prolongations'] = P
+        self.A = A
+        self.stats = {'method': self.method, 'n': A.shape[0],
+                      'nnz': getattr(A, 'nnz', None), 'tol': self.tol,
+                      'atol': self.atol, 'rtol0': self.rtol0}
+        method = self.method
+        if method == 'cholesky':
+            try:
+                from sksparse.cholmod import cholesky
+                with phase('factorization'):
+                    factor = cholesky(sparse.csc_matrix(A))
+                self._solve = factor
+                L = factor.L()
+                self.stats['factor_nnz'] = 2*L.nnz - L.shape[0]
+            except ImportError:
+                method = self.stats['method'] = 'direct'
+        if method == 'direct':
+            with phase('factorization'):
+                lu = sla.splu(sparse.csc_matrix(A),
+                              permc_spec=self.permc_spec)
+            self._solve = lu.solve
+            self.stats['permc_spec'] = self.permc_spec or 'COLAMD'
+            self.stats['factor_nnz'] = lu.L.nnz + lu.U.nnz
+        if method == 'cg':
+            self.stats['precond'] = self.precond
+            with phase('preconditioner'):
+                self.M = PRECONDITIONERS[self.precond](A, **kwargs)
+        if method == 'multigrid':
+            with phase('preconditioner'):
+                self.mg = Multigrid(A, **kwargs)
+            self.stats['levels'] = self.mg.levels
+        if 'factor_nnz' in self.stats:
+            # fill of the factors relative to the matrix
+            self.stats['fill'] = self.stats['factor_nnz']/max(A.nnz, 1)
+            gauge('factor_nnz', self.stats['factor_nnz'])
+            gauge('fill', self.stats['fill'])
+        self.stats['setup_time'] = time.perf_counter()-t0
+        return self
+
+    def _atol(self, b, x0):
+        if self.rtol0 is None:
+            return self.atol
+        r0 = b if x0 is None else b - self.A @ x0
+        return max(self.atol, self.rtol0*np.linalg.norm(r0))
+
+    def _cg(self, b, x0):
+        its = [0]
+        def count(xk):
+            its[0] += 1
+        kwargs = {_CG_TOL: self.tol}
+        x, info = sla.cg(self.A, b, x0=x0, atol=self._atol(b, x0),
+                         maxiter=self.maxiter, M=self.M, callback=count,
+                         **kwargs)
+        if info < 0:
+            raise RuntimeError('cg breakdown (info=%d)' % info)
+        return x, its[0], info == 0
+
+    def _mg(self, b, x0):
+        return self.mg.solve(b, x0, self.tol, self.maxiter,
+                             self._atol(b, x0))
+
+    def _iterate_block(self, solve, b, x0):
+        # column by column for several right hand sides
+        if b.ndim == 1:
+            x, its, conv = solve(b, x0)
+            return x, [its], [conv]
+        x = np.empty_like(b, dtype=float)
+        its, conv = [], []
+        for k in range(b.shape[1]):
+            xk0 = None if x0 is None else x0[:, k]
+            x[:, k], i, c = solve(b[:, k], xk0)
+            its.append(i)
+            conv.append(c)
+        return x, its, conv
+
+    def solve(self, b, x0=None):
+        """
+        Solve A x = b. b can hold several right hand sides as columns.
+        x0 is the initial guess of the iterative method.
+        """
+        if self.A is None:
+            raise RuntimeError('LinearSolver.solve called before setup')
+        t0 = time.perf_counter()
+        if self.perm is not None:
+            b = b[self.perm]
+            x0 = None if x0 is None else x0[self.perm]
+        if self.method in ('cg', 'multigrid'):
+            solve = self._cg if self.method == 'cg' else self._mg
+            with phase(self.method):
+                x, its, conv = self._iterate_block(solve, b, x0)
+            self.stats['iterations'] = its[0] if b.ndim == 1 else its
+            self.stats['converged'] = all(conv)
+            count(self.method + '_iterations', sum(its))
+        else:
+            with phase('triangular_solve'):
+                x = self._solve(b)
+            self.stats['iterations'] = 0
+            self.stats['converged'] = True
+        self.stats['solve_time'] = time.perf_counter()-t0
+
+        r = b - self.A @ x
+        nb = np.linalg.norm(b)
+        self.stats['residual'] = float(np.linalg.norm(r)/nb) if nb > 0 else 0.0
+        if self.perm is not None:
+            x, y = np.empty_like(x), x
+            x[self.perm] = y
+        return x
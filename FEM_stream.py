@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Chunked (out-of-core) assembly of the global stiffness matrix
+
+MatrixBuilder keeps all ne*nd*nd triplets of a mesh, which is what makes
+reassembly on the same mesh cheap, but at 10^7 elements the triplets
+alone take tens of GB. assemble_streaming() never holds more than one
+batch of elements:
+
+    1. the CSR sparsity comes from the vertex graph (vertices sharing an
+       element), built from element batches in blocks of vertex rows;
+       every vertex pair (a, b) is a 2x2 block of DOFs
+    2. element_blocks() yields the element matrices batch by batch and
+       each batch is summed straight into its slots of the CSR data
+
+Past mem_cap_mb the CSR arrays (and the vertex graph) are allocated as
+memory-mapped temporary files, so the resident memory is the part of
+the final matrix the OS keeps paged in plus one batch of elements.
+
+    K = assemble_streaming(V, E, chunk_size=20000, mem_cap_mb=2000)
+
+"""
+import os
+import tempfile
+
+import numpy as np
+import scipy.sparse as sparse
+
+from FEM_AMR_L_dom import element_stiffness, elasticity_matrix
+from FEM_profile import gauge, phase, profiled
+
+
+class SpillAllocator:
+    """
+    Array allocator with a memory budget: arrays are plain in-memory
+    arrays until the allocated total exceeds cap bytes (None for no
+    cap), after that they are memory-mapped files in a temporary
+    directory under tmpdir. The files are unlinked right away, the
+    mapping stays valid until the array is freed; where the OS does not
+    allow that (Windows) they are left in the directory.
+    """
+    def __init__(self, cap=None, tmpdir=None):
+        self.cap = cap
+        self.tmpdir = tmpdir
+        self.dir = None
+        self.used = 0
+
+    def empty(self, n, dtype):
+        dtype = np.dtype(dtype)
+        nbytes = n*dtype.itemsize
+        self.used += nbytes
+        if self.cap is None or self.used <= self.cap or n == 0:
+            return np.empty(n, dtype=dtype)
+        if self.dir is None:
+            self.dir = tempfile.mkdtemp(prefix='fem_stream_', dir=self.tmpdir)
+        path = os.path.join(self.dir, 'a%d.bin' % self.used)
+        arr = np.memmap(path, dtype=dtype, mode='w+', shape=(n,))
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        gauge('spilled_mb', nbytes/2**20)
+        return arr
+
+
+def element_batches(E, chunk_size):
+    """Yield (start, E[start:start+chunk_size]) over the elements."""
+    for lo in range(0, len(E), chunk_size):
+        yield lo, np.asarray(E[lo:lo+chunk_size])
+
+def element_blocks(V, E, C, chunk_size, pool=None):
+    """
+    Yield (elements, Ke) per batch of elements, Ke (nc, nd, nd) as from
+    element_stiffness. pool (optional) is a FEM_parallel.ElementPool.
+    """
+    for _, Ec in element_batches(E, chunk_size):
+        with phase('element_kernels'):
+            if pool is not None:
+                Ke = pool.stiffness(V, Ec, C)
+            else:
+                Ke = element_stiffness(V, Ec, C)
+        yield Ec, Ke
+
+def _vertex_pairs(Ec):
+    k = Ec.shape[1]
+    return (np.repeat(Ec, k, axis=1).ravel().astype(np.int64),
+            np.tile(Ec, (1, k)).ravel().astype(np.int64))
+
+def _vertex_pattern(E, nv, chunk_size, row_block=None, alloc=None):
+    """
+    Vertex adjacency of the mesh (diagonal included) as a CSR pattern:
+    vptr (nv+1,) and the sorted keys a*nv+b of its entries, which is
+    what the slot lookup searches. Vertex rows are processed in blocks
+    of row_block rows (default all), each block one pass over the
+    element batches, and written into the keys array as it is done, so
+    the duplicated pairs of only one block are held at a time.
+    """
+    alloc = alloc or SpillAllocator()
+    row_block = row_block or nv
+    k = E.shape[1]
+    # at most every node pair of every element plus the diagonal; only
+    # the part that is written is ever paged in, so it is not charged
+    # against the cap
+    bound = len(E)*k*(k-1) + nv
+    vkeys = alloc.empty(bound, np.int64)
+    vptr = np.zeros(nv+1, dtype=np.int64)
+    lo = 0
+    for r0 in range(0, nv, row_block):
+        r1 = min(nv, r0+row_block)
+        keys = []
+        for _, Ec in element_batches(E, chunk_size):
+            a, b = _vertex_pairs(Ec)
+            sel = (a >= r0) & (a < r1)
+            keys.append(np.unique(a[sel]*nv + b[sel]))
+        keys = np.unique(np.concatenate(keys))
+        vptr[r0+1:r1+1] = np.bincount(keys//nv - r0, minlength=r1-r0)
+        # the blocks are in row order, so the keys are globally sorted
+        vkeys[lo:lo+len(keys)] = keys
+        lo += len(keys)
+        del keys
+    alloc.used -= 8*(bound-lo)
+    np.cumsum(vptr, out=vptr)
+    return vptr, vkeys[:lo]
+
+@profiled('assembly')
+def assemble_streaming(V, E, C=None, chunk_size=10000, mem_cap_mb=None,
+                       tmpdir=None, pool=None):
+    """
+    Global stiffness matrix (CSR) of the mesh (V, E) assembled batch by
+    batch, see the module docstring. E may itself be a memory-mapped
+    array (e.g. from FEM_io.load_checkpoint). mem_cap_mb (optional)
+    is the budget past which the matrix arrays are memory-mapped files
+    under tmpdir (default the system temporary directory). A batch
+    takes about 2 kB per linear element while it is summed in.
+    """
+    if C is None:
+        C = elasticity_matrix()
+    nv = len(V)
+    k = E.shape[1]
+    cap = None if mem_cap_mb is None else mem_cap_mb*2**20
+    alloc = SpillAllocator(cap, tmpdir)
+
+    # rows per pattern block: the duplicated pairs of a block (k*k per
+    # element, two 8 byte copies while sorting) within a quarter of the cap
+    row_block = None
+    if cap is not None:
+        pairs_per_row = len(E)*k*k / max(nv, 1)
+        row_block = max(1024, int(cap/4 / (16*pairs_per_row)))
+    with phase('pattern'):
+        vptr, vkeys = _vertex_pattern(E, nv, chunk_size, row_block, alloc)
+        deg = np.diff(vptr)
+        nnz = 4*int(vptr[-1])
+        idx_type = np.int32 if nnz < np.iinfo(np.int32).max else np.int64
+        # DOF row 2a+i holds the 2*deg(a) columns 2b, 2b+1 of the
+        # neighbours b of vertex a
+        indptr = np.empty(2*nv+1, dtype=idx_type)
+        indptr[0:-1:2] = 4*vptr[:-1]
+        indptr[1::2] = 4*vptr[:-1] + 2*deg
+        indptr[-1] = nnz
+        indices = alloc.empty(nnz, idx_type)
+        step = max(1, chunk_size*k)
+        for r0 in range(0, nv, step):
+            r1 = min(nv, r0+step)
+            lo, hi = vptr[r0], vptr[r1]
+            cols = (2*(vkeys[lo:hi] % nv)[:, None]
+                    + np.arange(2)).ravel()
+            a = np.repeat(np.arange(r0, r1), 2*deg[r0:r1])
+            dest = np.arange(2*lo, 2*hi) + 2*vptr[a]
+            indices[dest] = cols
+            indices[dest + 2*deg[a]] = cols
+
+    data = alloc.empty(nnz, np.float64)
+    data[:] = 0.0
+    ij = np.arange(2)
+    for Ec, Ke in element_blocks(V, E, C, chunk_size, pool):
+        with phase('csr_scatter'):
+            a, b = _vertex_pairs(Ec)
+            kv = np.searchsorted(vkeys, a*nv + b)
+            base = (2*vptr[a] + 2*kv).reshape(len(Ec), k, 1, k, 1)
+            row_off = (2*deg[a]).reshape(len(Ec), k, 1, k, 1)
+            slots = (base + ij[:, None, None]*row_off
+                     + ij[None, None, :]).reshape(len(Ec), 2*k, 2*k)
+            # sum the duplicates within the batch, then add to the data
+            slots = slots.ravel()
+            order = np.argsort(slots, kind='stable')
+            slots = slots[order]
+            first = np.flatnonzero(np.r_[True, slots[1:] != slots[:-1]])
+            data[slots[first]] += np.add.reduceat(Ke.ravel()[order], first)
+    gauge('nnz', nnz)
+    # with spilled arrays K refers to the mappings, no copy is made
+    return sparse.csr_matrix((data, indices, indptr), shape=(2*nv, 2*nv),
+                             copy=False)